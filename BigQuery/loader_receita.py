@@ -32,6 +32,10 @@ TABLE_NAME = "receita_estabelecimentos"
 BUCKET_NAME = "dados-cnpjs"
 BASE_PATH = "receita_federal"
 
+# Padrões para extrair o período (YYYY-MM) dos caminhos do bucket
+PERIOD_PREFIX_PATTERN = re.compile(r'(\d{4}-\d{2})/?$')
+PERIOD_PATH_PATTERN = re.compile(rf'{re.escape(BASE_PATH)}/(\d{{4}}-\d{{2}})/')
+
 # Schema da Receita Federal (Estabelecimentos) - Todos como STRING
 # Baseado no layout oficial da Receita Federal
 ESTABELECIMENTOS_SCHEMA = [
@@ -95,7 +99,7 @@ def get_available_periods() -> List[str]:
     if blobs.prefixes:
         for prefix in blobs.prefixes:
             # Extrair ano-mes do prefixo: receita_federal/2023-05/ -> 2023-05
-            match = re.search(r'(\d{4}-\d{2})/?$', prefix)
+            match = PERIOD_PREFIX_PATTERN.search(prefix)
             if match:
                 periods.add(match.group(1))
     
@@ -105,7 +109,7 @@ def get_available_periods() -> List[str]:
         all_blobs = bucket.list_blobs(prefix=f"{BASE_PATH}/")
         for blob in all_blobs:
             # Extrair ano-mes do path: receita_federal/2023-05/arquivo.csv -> 2023-05
-            match = re.search(rf'{BASE_PATH}/(\d{{4}}-\d{{2}})/', blob.name)
+            match = PERIOD_PATH_PATTERN.search(blob.name)
             if match:
                 periods.add(match.group(1))
     
@@ -6,9 +6,12 @@ e carregar no BigQuery
 import os
 import pandas as pd
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import json
 import base64
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 from google.cloud import bigquery
 import functions_framework
 
@@ -51,6 +54,17 @@ SERIES_BCB = {
 
 DATA_INICIO_COLETA = os.environ.get("DATA_INICIO", "01/01/2016")
 
+# Séries buscadas simultaneamente na API do SGS (chamadas independentes, limitadas por I/O)
+FETCH_WORKERS = int(os.environ.get("FETCH_WORKERS", "8"))
+
+# Sessão HTTP compartilhada (keep-alive: reaproveita conexões TCP/TLS entre as séries)
+# Erros transitórios da API (429/5xx) são repetidos com espera exponencial
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(
+    pool_maxsize=FETCH_WORKERS,
+    max_retries=Retry(total=3, backoff_factor=1, status_forcelist=(429, 500, 502, 503, 504)),
+))
+
 
 # =============================================================================
 # FUNÇÕES
@@ -72,7 +86,7 @@ def buscar_serie_temporal_bcb(codigo_serie, nome_coluna, data_inicio="01/01/2010
     url = f"https://api.bcb.gov.br/dados/serie/bcdata.sgs.{codigo_serie}/dados?formato=json&dataInicial={data_inicio}"
     
     try:
-        response = requests.get(url, timeout=30)
+        response = SESSION.get(url, timeout=30)
         response.raise_for_status()
         dados = response.json()
         
@@ -118,29 +132,31 @@ def coletar_indicadores_economicos():
     """
     DATA_INICIO_COLETA = os.environ.get("DATA_INICIO", "01/01/2016")
 
-    dfs_indicadores = []
-
-    for codigo, nome in SERIES_BCB.items():
+    def buscar(item):
+        codigo, nome = item
         print(f"Coletando série: {nome} (Código: {codigo})...")
-        df_serie = buscar_serie_temporal_bcb(codigo, nome, DATA_INICIO_COLETA)
-        if not df_serie.empty:
-            dfs_indicadores.append(df_serie)
+        return buscar_serie_temporal_bcb(codigo, nome, DATA_INICIO_COLETA)
+
+    # Busca as séries em paralelo; map preserva a ordem de SERIES_BCB
+    with ThreadPoolExecutor(max_workers=FETCH_WORKERS) as executor:
+        series = list(executor.map(buscar, SERIES_BCB.items()))
+
+    dfs_indicadores = [df_serie for df_serie in series if not df_serie.empty]
 
     if not dfs_indicadores:
         print("Nenhuma série foi coletada com sucesso.")
         return pd.DataFrame()
 
-    # 1. Combina todos os DataFrames em um único
-    df_final = dfs_indicadores[0]
-    for i in range(1, len(dfs_indicadores)):
-        df_final = pd.merge(df_final, dfs_indicadores[i], on='ano_mes', how='outer')
+    # 1. Combina todos os DataFrames em um único, alinhando pelo ano_mes
+    # (um só concat, em vez de um merge - e uma cópia do acumulado - por série).
+    # As colunas de valor já chegam numéricas de buscar_serie_temporal_bcb
+    df_final = pd.concat(
+        [df_serie.set_index('ano_mes') for df_serie in dfs_indicadores],
+        axis=1,
+        join='outer'
+    ).rename_axis('ano_mes').reset_index()
 
-    # 2. Converte todas as colunas de valor para tipo numérico
-    for col in df_final.columns:
-        if col != 'ano_mes':
-            df_final[col] = pd.to_numeric(df_final[col], errors='coerce')
-
-    # 3. Ordena o DataFrame por ano_mes
+    # 2. Ordena o DataFrame por ano_mes
     df_final.sort_values(by='ano_mes', inplace=True)
     df_final.reset_index(drop=True, inplace=True)
 
@@ -264,12 +280,15 @@ def banco_central_http(request):
     # Determinar modo de escrita
     write_mode = request.args.get('mode', 'WRITE_APPEND')
     
-    # Carregar versão bronze (dados brutos)
-    bronze_result = carregar_no_bigquery(df, f"{TABLE_NAME}_bronze", write_mode)
-    
     # Criar versão silver (dados tratados - preenchimento de nulos)
     df_silver = df.fillna(df.mean(numeric_only=True))
-    silver_result = carregar_no_bigquery(df_silver, f"{TABLE_NAME}_silver", write_mode)
+    
+    # Carregar versões bronze (dados brutos) e silver em paralelo (tabelas independentes)
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        bronze_future = executor.submit(carregar_no_bigquery, df, f"{TABLE_NAME}_bronze", write_mode)
+        silver_future = executor.submit(carregar_no_bigquery, df_silver, f"{TABLE_NAME}_silver", write_mode)
+        bronze_result = bronze_future.result()
+        silver_result = silver_future.result()
     
     return {
         'status': 'success' if bronze_result['status'] == 'success' and silver_result['status'] == 'success' else 'partial',
@@ -316,12 +335,15 @@ def banco_central_pubsub(cloud_event):
     # Modo de escrita da mensagem
     write_mode = message_data.get('mode', 'WRITE_APPEND')
     
-    # Carregar versão bronze (dados brutos)
-    bronze_result = carregar_no_bigquery(df, f"{TABLE_NAME}_bronze", write_mode)
-    
     # Criar versão silver (dados tratados - preenchimento de nulos)
     df_silver = df.fillna(df.mean(numeric_only=True))
-    silver_result = carregar_no_bigquery(df_silver, f"{TABLE_NAME}_silver", write_mode)
+    
+    # Carregar versões bronze (dados brutos) e silver em paralelo (tabelas independentes)
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        bronze_future = executor.submit(carregar_no_bigquery, df, f"{TABLE_NAME}_bronze", write_mode)
+        silver_future = executor.submit(carregar_no_bigquery, df_silver, f"{TABLE_NAME}_silver", write_mode)
+        bronze_result = bronze_future.result()
+        silver_result = silver_future.result()
     
     return {
         'status': 'success' if bronze_result['status'] == 'success' and silver_result['status'] == 'success' else 'partial',
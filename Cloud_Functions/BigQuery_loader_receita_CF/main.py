@@ -17,6 +17,7 @@ import os
 import json
 import base64
 import re
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Dict, Optional
 
 from google.cloud import bigquery
@@ -34,6 +35,10 @@ TABLE_NAME_EMPRESAS = os.environ.get('TABLE_NAME_EMPRESAS', 'receita_empresas')
 BUCKET_NAME = os.environ.get('BUCKET_NAME', 'dados-cnpjs')
 BASE_PATH = os.environ.get('BASE_PATH', 'receita_federal')
 
+# Padrões para extrair o período (YYYY-MM) dos caminhos do bucket
+PERIOD_PREFIX_PATTERN = re.compile(r'(\d{4}-\d{2})/?$')
+PERIOD_PATH_PATTERN = re.compile(rf'{re.escape(BASE_PATH)}/(\d{{4}}-\d{{2}})/')
+
 # Schema da Receita Federal (Estabelecimentos) - Todos como STRING
 ESTABELECIMENTOS_SCHEMA = [
     bigquery.SchemaField("cnpj_basico", "STRING"),
@@ -116,14 +121,14 @@ def get_available_periods() -> List[str]:
     
     if blobs.prefixes:
         for prefix in blobs.prefixes:
-            match = re.search(r'(\d{4}-\d{2})/?$', prefix)
+            match = PERIOD_PREFIX_PATTERN.search(prefix)
             if match:
                 periods.add(match.group(1))
     
     if not periods:
         all_blobs = bucket.list_blobs(prefix=f"{BASE_PATH}/")
         for blob in all_blobs:
-            match = re.search(rf'{BASE_PATH}/(\d{{4}}-\d{{2}})/', blob.name)
+            match = PERIOD_PATH_PATTERN.search(blob.name)
             if match:
                 periods.add(match.group(1))
     
@@ -251,6 +256,63 @@ def insert_from_temp_to_final(client: bigquery.Client, ano_mes: str, data_type:
         return {'status': 'error', 'error': str(e)}
 
 
+def load_data_type_periods(client: bigquery.Client, data_type: str, periods: List[str]) -> Dict:
+    """
+    Carrega todos os períodos de um tipo de dado na sua tabela final
+    
+    Args:
+        client: Cliente do BigQuery
+        data_type: Tipo de dado ('estabelecimentos' ou 'empresas')
+        periods: Períodos no formato YYYY-MM (o primeiro substitui a tabela)
+    """
+    print(f"\n{'=' * 80}")
+    print(f"Processando {DATA_TYPES_CONFIG[data_type]['description']}")
+    print(f"{'=' * 80}")
+    
+    results = []
+    total_rows = 0
+    
+    for idx, ano_mes in enumerate(periods):
+        print(f"[{idx + 1}/{len(periods)}] Processando {data_type} - {ano_mes}...")
+        
+        load_result = load_period_to_temp(client, ano_mes, data_type)
+        
+        if load_result['status'] == 'success':
+            is_first = (idx == 0)
+            insert_result = insert_from_temp_to_final(client, ano_mes, data_type, is_first)
+            
+            if insert_result['status'] == 'success':
+                total_rows += insert_result['rows']
+                results.append({
+                    'period': ano_mes,
+                    'status': 'success',
+                    'rows': insert_result['rows']
+                })
+            else:
+                results.append({
+                    'period': ano_mes,
+                    'status': 'error',
+                    'error': insert_result['error']
+                })
+        else:
+            results.append({
+                'period': ano_mes,
+                'status': 'error',
+                'error': load_result['error']
+            })
+    
+    success_count = sum(1 for r in results if r['status'] == 'success')
+    error_count = len(results) - success_count
+    
+    return {
+        'status': 'success' if error_count == 0 else 'partial',
+        'total_rows': total_rows,
+        'periods_processed': success_count,
+        'periods_failed': error_count,
+        'results': results
+    }
+
+
 def load_receita_data(data_types: Optional[List[str]] = None) -> Dict:
     """
     Carrega todos os dados da Receita Federal para o BigQuery
@@ -272,57 +334,16 @@ def load_receita_data(data_types: Optional[List[str]] = None) -> Dict:
     if not periods:
         return {'status': 'error', 'error': 'Nenhum período encontrado'}
     
-    all_results = {}
-    total_rows_all = {}
-    
-    for data_type in data_types:
-        print(f"\n{'=' * 80}")
-        print(f"Processando {DATA_TYPES_CONFIG[data_type]['description']}")
-        print(f"{'=' * 80}")
-        
-        results = []
-        total_rows = 0
-        
-        for idx, ano_mes in enumerate(periods):
-            print(f"[{idx + 1}/{len(periods)}] Processando {data_type} - {ano_mes}...")
-            
-            load_result = load_period_to_temp(client, ano_mes, data_type)
-            
-            if load_result['status'] == 'success':
-                is_first = (idx == 0)
-                insert_result = insert_from_temp_to_final(client, ano_mes, data_type, is_first)
-                
-                if insert_result['status'] == 'success':
-                    total_rows += insert_result['rows']
-                    results.append({
-                        'period': ano_mes,
-                        'status': 'success',
-                        'rows': insert_result['rows']
-                    })
-                else:
-                    results.append({
-                        'period': ano_mes,
-                        'status': 'error',
-                        'error': insert_result['error']
-                    })
-            else:
-                results.append({
-                    'period': ano_mes,
-                    'status': 'error',
-                    'error': load_result['error']
-                })
-        
-        success_count = sum(1 for r in results if r['status'] == 'success')
-        error_count = len(results) - success_count
-        
-        all_results[data_type] = {
-            'status': 'success' if error_count == 0 else 'partial',
-            'total_rows': total_rows,
-            'periods_processed': success_count,
-            'periods_failed': error_count,
-            'results': results
+    # Cada tipo tem suas próprias tabelas (temporárias e final): os tipos são
+    # carregados em paralelo; os períodos de um mesmo tipo seguem em ordem
+    with ThreadPoolExecutor(max_workers=max(1, len(data_types))) as executor:
+        futures = {
+            data_type: executor.submit(load_data_type_periods, client, data_type, periods)
+            for data_type in data_types
         }
-        total_rows_all[data_type] = total_rows
+        all_results = {data_type: future.result() for data_type, future in futures.items()}
+    
+    total_rows_all = {data_type: result['total_rows'] for data_type, result in all_results.items()}
     
     # Status geral
     overall_status = 'success'
@@ -356,20 +377,20 @@ def load_receita_by_period(ano_mes: str, data_types: Optional[List[str]] = None,
     for data_type in data_types:
         create_final_table(client, data_type)
     
-    results = {}
-    
-    for data_type in data_types:
+    def load_data_type(data_type: str) -> Dict:
         print(f"\nProcessando {DATA_TYPES_CONFIG[data_type]['description']} - {ano_mes}...")
         
         load_result = load_period_to_temp(client, ano_mes, data_type)
         
         if load_result['status'] != 'success':
-            results[data_type] = load_result
-            continue
+            return load_result
         
         is_first = not append
-        insert_result = insert_from_temp_to_final(client, ano_mes, data_type, is_first)
-        results[data_type] = insert_result
+        return insert_from_temp_to_final(client, ano_mes, data_type, is_first)
+    
+    # Tipos independentes (tabelas distintas): carregados em paralelo
+    with ThreadPoolExecutor(max_workers=max(1, len(data_types))) as executor:
+        results = dict(zip(data_types, executor.map(load_data_type, data_types)))
     
     # Se apenas um tipo, retorna resultado direto; caso contrário, retorna dict
     if len(data_types) == 1:
@@ -8,15 +8,33 @@ Baixa, extrai e deleta ZIPs automaticamente
 import os
 import io
 import zipfile
-import json
+import zlib
 import base64
-from typing import List, Tuple, Dict
+import random
+import time
+import shutil
+import socket
+import threading
+from datetime import date, datetime, timezone
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import List, Tuple, Dict, Set
 from pathlib import Path
 
+import orjson
 import requests
+from google.api_core.exceptions import NotFound
 from google.cloud import storage
 import functions_framework
 
+# DEFLATE acelerado (ISA-L, 2-4x mais rápido) na extração dos ZIPs, se disponível
+try:
+    from isal import isal_zlib
+    zipfile.zlib = isal_zlib
+    zipfile.crc32 = isal_zlib.crc32
+    DECOMPRESSION_ERRORS = (zipfile.BadZipFile, zlib.error, isal_zlib.error)
+except ImportError:
+    DECOMPRESSION_ERRORS = (zipfile.BadZipFile, zlib.error)
+
 
 # =============================================================================
 # CONFIGURAÇÕES
@@ -24,6 +42,7 @@ import functions_framework
 BASE_URL = "https://dadosabertos.pgfn.gov.br"
 DESTINATION_BUCKET_NAME = os.environ.get('DESTINATION_BUCKET_NAME', 'seu-bucket-aqui')
 BASE_PATH = os.environ.get('BASE_PATH', 'fazenda_nacional')  # Caminho base no bucket
+MANIFEST_PATH = f'{BASE_PATH}/manifest.json'  # Registro dos downloads concluídos
 
 # Tipos de dados disponíveis
 DATA_TYPES = [
@@ -35,7 +54,18 @@ DATA_TYPES = [
 # Configurações de download
 MAX_RETRIES = 3
 TIMEOUT = (30, 500)  # (connect timeout, read timeout)
-CHUNK_SIZE = 8192
+BACKOFF_BASE = 1.0  # Espera inicial entre tentativas (segundos)
+BACKOFF_MAX = 30.0  # Espera máxima entre tentativas (segundos)
+CHUNK_SIZE = 1 << 20  # 1 MiB
+UPLOAD_CHUNK_SIZE = 16 * 1024 * 1024  # Buffer do upload resumable para o GCS (múltiplo de 256 KiB)
+# Downloads simultâneos. Cada worker mantém um ZIP inteiro em memória, mais
+# EXTRACT_WORKERS buffers de upload de UPLOAD_CHUNK_SIZE, então o pico é
+# ~DOWNLOAD_WORKERS ZIPs: só aumente se a memória da função comportar
+# (ex.: 2 workers com --memory=4Gi)
+DOWNLOAD_WORKERS = int(os.environ.get('DOWNLOAD_WORKERS', '1'))
+HEAD_WORKERS = 16  # Verificações HEAD simultâneas antes dos downloads
+EXTRACT_WORKERS = int(os.environ.get('EXTRACT_WORKERS', '4'))  # Arquivos de um mesmo ZIP extraídos/enviados em paralelo
+HEAD_TIMEOUT = (10, 10)  # HEAD não transfere corpo: timeout curto
 
 # Anos e trimestres
 START_YEAR = int(os.environ.get('START_YEAR', '2020'))
@@ -46,21 +76,74 @@ END_YEAR = int(os.environ.get('END_YEAR', '2025'))
 storage_client = storage.Client()
 bucket = storage_client.bucket(DESTINATION_BUCKET_NAME)
 
+# Sessão HTTP compartilhada (reaproveita conexões TCP/TLS entre downloads)
+# O pool comporta a rodada de HEADs em paralelo, não só os downloads: com menos
+# conexões o urllib3 abriria e descartaria conexões extras a cada HEAD
+SESSION = requests.Session()
+SESSION.mount('https://', requests.adapters.HTTPAdapter(pool_maxsize=max(DOWNLOAD_WORKERS, HEAD_WORKERS)))
+
+
+def prewarm_connections():
+    """
+    Aquece as conexões no cold start da função
+    Resolve DNS, abre o canal com o GCS e faz o handshake TLS com a PGFN
+    antes do primeiro request chegar ao handler (roda em thread daemon, com
+    timeout curto, para nunca atrasar o cold start se a PGFN estiver lenta)
+    """
+    try:
+        socket.getaddrinfo('dadosabertos.pgfn.gov.br', 443)
+    except OSError:
+        pass
+    
+    try:
+        bucket.exists()
+    except Exception:
+        pass
+    
+    try:
+        SESSION.head(BASE_URL, timeout=HEAD_TIMEOUT)
+    except requests.exceptions.RequestException:
+        pass
+
+
+threading.Thread(target=prewarm_connections, daemon=True).start()
+
 
 # =============================================================================
 # FUNÇÕES AUXILIARES
 # =============================================================================
 
+def backoff_delay(attempt: int, response: requests.Response = None) -> float:
+    """Espera entre tentativas: Retry-After da PGFN ou backoff com jitter, sempre até BACKOFF_MAX"""
+    retry_after = response.headers.get('Retry-After', '') if response is not None else ''
+    if retry_after.isdigit():
+        return min(float(retry_after), BACKOFF_MAX)
+    return min(BACKOFF_MAX, BACKOFF_BASE * (2 ** attempt) * (1 + random.uniform(0, 0.5)))
+
+
+def is_retryable(error: requests.exceptions.RequestException) -> bool:
+    """Erros HTTP 4xx (exceto 408 e 429) não adiantam repetir"""
+    response = getattr(error, 'response', None)
+    if isinstance(error, requests.exceptions.HTTPError) and response is not None:
+        return not (400 <= response.status_code < 500) or response.status_code in (408, 429)
+    return True
+
+
 def get_downloads_list() -> List[Tuple[int, int, str]]:
     """
     Gera lista de downloads (ano, trimestre, tipo)
     Todos os anos: 4 trimestres cada (START_YEAR até END_YEAR inclusive)
+    Trimestres posteriores ao atual são ignorados (ainda não foram publicados)
     """
     downloads = []
+    today = date.today()
+    current = (today.year, (today.month - 1) // 3 + 1)
     
     # Todos os anos completos (4 trimestres cada)
     for year in range(START_YEAR, END_YEAR + 1):  # +1 para incluir END_YEAR
         for quarter in range(1, 5):  # 4 trimestres
+            if (year, quarter) > current:
+                continue
             for data_type in DATA_TYPES:
                 downloads.append((year, quarter, data_type))
     
@@ -105,6 +188,17 @@ def create_extraction_marker(year: int, quarter: int, data_type: str):
     blob.upload_from_string('extracted', content_type='text/plain')
 
 
+def upload_member(zip_ref: zipfile.ZipFile, member: zipfile.ZipInfo, blob_path: str):
+    """
+    Descompacta um arquivo do ZIP direto para o GCS em streaming
+    Se a cópia falhar, o upload resumable é cancelado (nenhum CSV parcial é publicado)
+    """
+    blob = bucket.blob(blob_path)
+    with zip_ref.open(member) as src, \
+            blob.open('wb', chunk_size=UPLOAD_CHUNK_SIZE, content_type='text/csv') as dst:
+        shutil.copyfileobj(src, dst, length=CHUNK_SIZE)
+
+
 def list_csv_files_in_path(year: int, quarter: int, data_type: str) -> List[str]:
     """Lista arquivos CSV já existentes no caminho do bucket"""
     prefix = get_blob_path(year, quarter, data_type, None)
@@ -113,15 +207,98 @@ def list_csv_files_in_path(year: int, quarter: int, data_type: str) -> List[str]
     return csv_files
 
 
+def load_manifest() -> Dict[str, Dict]:
+    """
+    Carrega o manifesto de downloads concluídos (url -> {size, etag, completed_at})
+    Retorna dicionário vazio se o manifesto ainda não existir
+    """
+    try:
+        return orjson.loads(bucket.blob(MANIFEST_PATH).download_as_bytes())
+    except NotFound:
+        return {}
+
+
+def save_manifest(manifest: Dict[str, Dict]):
+    """Grava o manifesto de downloads concluídos no bucket"""
+    bucket.blob(MANIFEST_PATH).upload_from_string(
+        orjson.dumps(manifest, option=orjson.OPT_INDENT_2 | orjson.OPT_SORT_KEYS),
+        content_type='application/json'
+    )
+
+
+def list_completed_paths() -> Set[str]:
+    """
+    Lista de uma só vez os caminhos (BASE_PATH/ano/trimestre/tipo) já processados
+    Considera processado o caminho com marcador de extração ou com CSVs
+    """
+    completed = set()
+    for blob in bucket.list_blobs(prefix=f"{BASE_PATH}/"):
+        if blob.name.endswith('/.extracted') or blob.name.endswith('.csv'):
+            completed.add(blob.name.rsplit('/', 1)[0])
+    return completed
+
+
+def url_available(url: str) -> bool:
+    """
+    Verifica via HEAD se o arquivo existe no servidor da PGFN
+    Em caso de erro de rede assume que existe (o download trata as falhas)
+    """
+    try:
+        response = SESSION.head(url, timeout=HEAD_TIMEOUT, allow_redirects=True)
+        return response.status_code != 404
+    except requests.exceptions.RequestException:
+        return True
+
+
+def filter_pending_downloads(
+    downloads: List[Tuple[int, int, str]],
+    manifest: Dict[str, Dict]
+) -> Tuple[List[Tuple[int, int, str]], int, List[Tuple[int, int, str]]]:
+    """
+    Separa os downloads pendentes dos já processados e dos inexistentes
+    (ex: trimestres futuros)
+    Os que constam no manifesto são descartados direto; os demais são
+    verificados com uma listagem do bucket e HEADs em paralelo
+    Retorna: (pendentes, quantidade_ja_processada, nao_encontrados)
+    """
+    candidates = [d for d in downloads if build_url(*d) not in manifest]
+    already_done = len(downloads) - len(candidates)
+    
+    if not candidates:
+        return [], already_done, []
+    
+    with ThreadPoolExecutor(max_workers=HEAD_WORKERS) as executor:
+        completed_future = executor.submit(list_completed_paths)
+        available = list(executor.map(lambda d: url_available(build_url(*d)), candidates))
+        completed = completed_future.result()
+    
+    pending = []
+    not_found = []
+    
+    for download, is_available in zip(candidates, available):
+        if get_blob_path(*download) in completed:
+            # Processado antes do manifesto existir: registra para as próximas execuções
+            manifest[build_url(*download)] = {'size': None, 'etag': None, 'completed_at': None}
+            already_done += 1
+        elif not is_available:
+            not_found.append(download)
+        else:
+            pending.append(download)
+    
+    return pending, already_done, not_found
+
+
 def download_and_extract_to_gcs(
     url: str, 
     year: int, 
     quarter: int, 
     data_type: str,
-    retry_count: int = 0
+    manifest: Dict[str, Dict] = None
 ) -> Tuple[bool, bool]:
     """
     Baixa ZIP, extrai conteúdo para GCS e deleta ZIP (em memória)
+    Tenta até MAX_RETRIES vezes em caso de timeout, erro de rede ou ZIP corrompido
+    Se um manifesto for informado, registra nele o download concluído
     Retorna: (download_success, extraction_success)
     """
     filename = f"{data_type}.zip"
@@ -138,104 +315,105 @@ def download_and_extract_to_gcs(
             print(f"   ✓ {len(existing_csvs)} arquivos CSV já existem, pulando...")
             create_extraction_marker(year, quarter, data_type)
             return (True, True)
-        
-        retry_msg = f" (tentativa {retry_count + 1}/{MAX_RETRIES})" if retry_count > 0 else ""
-        print(f"   ⬇️  Baixando{retry_msg}: {filename}")
-        
-        # Download do arquivo ZIP em memória
-        response = requests.get(url, stream=True, timeout=TIMEOUT)
-        response.raise_for_status()
-        
-        # Ler conteúdo do ZIP em memória
-        zip_content = io.BytesIO()
-        total_size = int(response.headers.get('content-length', 0))
-        downloaded = 0
-        
-        for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
-            if chunk:
-                zip_content.write(chunk)
-                downloaded += len(chunk)
-                if total_size > 0 and downloaded % (CHUNK_SIZE * 100) == 0:
-                    percent = (downloaded / total_size) * 100
-                    print(f'   Progress: {percent:.1f}%')
-        
-        print(f"   ✓ Download concluído: {downloaded / 1024 / 1024:.1f} MB")
-        
-        # Verificar integridade do ZIP
-        zip_content.seek(0)
+    except Exception as e:
+        print(f"   ✗ Erro inesperado: {str(e)[:100]}")
+        return (False, False)
+    
+    for attempt in range(MAX_RETRIES):
+        error_response = None
         try:
-            with zipfile.ZipFile(zip_content, 'r') as zf:
-                if zf.testzip() is not None:
-                    raise zipfile.BadZipFile("Arquivo corrompido")
-        except zipfile.BadZipFile as e:
-            print(f"   ✗ ZIP corrompido: {e}")
+            retry_msg = f" (tentativa {attempt + 1}/{MAX_RETRIES})" if attempt > 0 else ""
+            print(f"   ⬇️  Baixando{retry_msg}: {filename}")
             
-            # Tentar novamente se ainda tiver tentativas
-            if retry_count < MAX_RETRIES - 1:
-                print(f"   🔄 Tentando novamente...")
-                return download_and_extract_to_gcs(url, year, quarter, data_type, retry_count + 1)
-            else:
-                return (False, False)
-        
-        # Extrair e fazer upload dos arquivos
-        print(f"   📦 Extraindo e enviando para GCS...")
-        zip_content.seek(0)
-        
-        with zipfile.ZipFile(zip_content, 'r') as zip_ref:
-            members = zip_ref.namelist()
-            files_uploaded = 0
+            # Download do arquivo ZIP em memória
+            response = SESSION.get(url, stream=True, timeout=TIMEOUT)
+            response.raise_for_status()
             
-            for member in members:
-                if not member.endswith('/'):  # Ignorar diretórios
-                    # Ler arquivo do ZIP
-                    file_data = zip_ref.read(member)
-                    
-                    # Extrair apenas o nome do arquivo (sem caminhos internos do ZIP)
-                    member_name = Path(member).name
-                    
-                    # Upload para GCS
-                    blob_path = get_blob_path(year, quarter, data_type, member_name)
-                    blob = bucket.blob(blob_path)
-                    blob.upload_from_string(file_data, content_type='text/csv')
-                    
-                    files_uploaded += 1
-                    
-                    if files_uploaded % 5 == 0:
-                        print(f'   ... {files_uploaded}/{len(members)} arquivos enviados')
+            # Ler conteúdo do ZIP em memória (cópia em nível C, blocos de 1 MiB)
+            zip_content = io.BytesIO()
+            response.raw.decode_content = True
+            shutil.copyfileobj(response.raw, zip_content, length=CHUNK_SIZE)
+            downloaded = zip_content.tell()
             
-            print(f"   ✅ Extraído: {files_uploaded} arquivos")
+            print(f"   ✓ Download concluído: {downloaded / 1024 / 1024:.1f} MB")
             
-            # Criar marcador de extração
-            create_extraction_marker(year, quarter, data_type)
-        
-        # ZIP é automaticamente deletado (estava em memória)
-        print(f"   🗑️  ZIP removido da memória")
-        
-        return (True, True)
-        
-    except requests.exceptions.Timeout:
-        print(f"   ✗ Timeout ao baixar {url}")
-        
-        # Tentar novamente
-        if retry_count < MAX_RETRIES - 1:
-            print(f"   🔄 Tentando novamente...")
-            return download_and_extract_to_gcs(url, year, quarter, data_type, retry_count + 1)
-        else:
-            return (False, False)
+            # Checagem barata (só o registro EOCD no fim do arquivo): descarta páginas
+            # de erro ou downloads truncados antes de tentar extrair
+            if not zipfile.is_zipfile(zip_content):
+                raise zipfile.BadZipFile('Conteúdo baixado não é um ZIP válido')
+            
+            # Extrair e fazer upload dos arquivos
+            # (o CRC de cada membro é verificado durante a leitura: um ZIP corrompido
+            # levanta BadZipFile/zlib.error sem precisar de uma passada extra com testzip)
+            print(f"   📦 Extraindo e enviando para GCS...")
+            zip_content.seek(0)
+            
+            with zipfile.ZipFile(zip_content, 'r') as zip_ref:
+                # Ignorar diretórios
+                members = [member for member in zip_ref.infolist() if not member.is_dir()]
+                files_uploaded = 0
+                
+                # Membros independentes: descompressão (zlib/ISA-L liberam o GIL) e
+                # upload de vários arquivos do mesmo ZIP ao mesmo tempo
+                with ThreadPoolExecutor(max_workers=EXTRACT_WORKERS) as executor:
+                    futures = [
+                        executor.submit(
+                            upload_member,
+                            zip_ref,
+                            member,
+                            # Extrair apenas o nome do arquivo (sem caminhos internos do ZIP)
+                            get_blob_path(year, quarter, data_type, Path(member.filename).name)
+                        )
+                        for member in members
+                    ]
+                    for future in as_completed(futures):
+                        future.result()
+                        files_uploaded += 1
+                        
+                        if files_uploaded % 5 == 0:
+                            print(f'   ... {files_uploaded}/{len(members)} arquivos enviados')
+                
+                print(f"   ✅ Extraído: {files_uploaded} arquivos")
+                
+                # Criar marcador de extração
+                create_extraction_marker(year, quarter, data_type)
+            
+            if manifest is not None:
+                manifest[url] = {
+                    'size': downloaded,
+                    'etag': response.headers.get('ETag'),
+                    'completed_at': datetime.now(timezone.utc).isoformat()
+                }
+            
+            # Libera o buffer do ZIP imediatamente (sem esperar o coletor de lixo)
+            zip_content.close()
+            print(f"   🗑️  ZIP removido da memória")
+            
+            return (True, True)
+            
+        except requests.exceptions.Timeout:
+            print(f"   ✗ Timeout ao baixar {url}")
+            
+        except requests.exceptions.RequestException as e:
+            print(f"   ✗ Erro ao baixar {url}: {e}")
+            # Erros 4xx como 404 não se resolvem repetindo
+            if not is_retryable(e):
+                return (False, False)
+            error_response = e.response
             
-    except requests.exceptions.RequestException as e:
-        print(f"   ✗ Erro ao baixar {url}: {e}")
+        except DECOMPRESSION_ERRORS as e:
+            print(f"   ✗ ZIP corrompido: {e}")
+            
+        except Exception as e:
+            print(f"   ✗ Erro inesperado: {str(e)[:100]}")
+            return (False, False)
         
-        # Tentar novamente
-        if retry_count < MAX_RETRIES - 1:
+        # Tentar novamente se ainda tiver tentativas
+        if attempt < MAX_RETRIES - 1:
             print(f"   🔄 Tentando novamente...")
-            return download_and_extract_to_gcs(url, year, quarter, data_type, retry_count + 1)
-        else:
-            return (False, False)
-            
-    except Exception as e:
-        print(f"   ✗ Erro inesperado: {str(e)[:100]}")
-        return (False, False)
+            time.sleep(backoff_delay(attempt, error_response))
+    
+    return (False, False)
 
 
 def process_downloads(downloads: List[Tuple[int, int, str]]) -> Dict[str, int]:
@@ -254,22 +432,54 @@ def process_downloads(downloads: List[Tuple[int, int, str]]) -> Dict[str, int]:
     
     print(f"\n📋 Total de arquivos para processar: {total}\n")
     
-    for idx, (year, quarter, data_type) in enumerate(downloads, 1):
-        print(f"[{idx}/{total}] {year} - Trimestre {quarter} - {data_type}")
-        
+    # Descarta de uma vez os já processados e os que não existem no servidor
+    manifest = load_manifest()
+    saved_size = len(manifest)
+    downloads, already_done, not_found = filter_pending_downloads(downloads, manifest)
+    stats['successful_downloads'] += already_done
+    stats['successful_extractions'] += already_done
+    stats['failed_downloads'] += len(not_found)
+    
+    print(f"   ✓ {already_done} já processados anteriormente")
+    for year, quarter, data_type in not_found:
+        print(f"   ✗ Não disponível no servidor: {year} - Trimestre {quarter} - {data_type}")
+    print(f"   ⬇️  {len(downloads)} pendentes\n")
+    
+    def checkpoint_manifest():
+        # Grava o manifesto a cada item concluído: se a função estourar o timeout,
+        # os downloads já finalizados não são refeitos na próxima execução
+        nonlocal saved_size
+        if len(manifest) != saved_size:
+            snapshot = dict(manifest)  # cópia: os workers continuam registrando itens
+            save_manifest(snapshot)
+            saved_size = len(snapshot)
+    
+    checkpoint_manifest()
+    
+    def process_item(item: Tuple[int, Tuple[int, int, str]]) -> Tuple[bool, bool]:
+        idx, (year, quarter, data_type) = item
+        print(f"[{idx}/{len(downloads)}] {year} - Trimestre {quarter} - {data_type}")
         url = build_url(year, quarter, data_type)
-        download_ok, extract_ok = download_and_extract_to_gcs(url, year, quarter, data_type)
-        
-        if download_ok:
-            stats['successful_downloads'] += 1
-            if extract_ok:
-                stats['successful_extractions'] += 1
-            else:
-                stats['failed_extractions'] += 1
-        else:
-            stats['failed_downloads'] += 1
-        
-        print()  # Linha em branco entre items
+        return download_and_extract_to_gcs(url, year, quarter, data_type, manifest)
+    
+    # Pool de DOWNLOAD_WORKERS downloads (padrão 1: um ZIP por vez, por memória);
+    # com mais workers, cada um pega o próximo item assim que termina o atual
+    with ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS) as executor:
+        futures = [executor.submit(process_item, item) for item in enumerate(downloads, 1)]
+        try:
+            for future in as_completed(futures):
+                download_ok, extract_ok = future.result()
+                if download_ok:
+                    stats['successful_downloads'] += 1
+                    if extract_ok:
+                        stats['successful_extractions'] += 1
+                    else:
+                        stats['failed_extractions'] += 1
+                else:
+                    stats['failed_downloads'] += 1
+                checkpoint_manifest()
+        finally:
+            checkpoint_manifest()
     
     return stats
 
@@ -329,7 +539,7 @@ def download_fazenda_pubsub(cloud_event):
     """
     try:
         message_data_str = base64.b64decode(cloud_event.data["message"]["data"]).decode("utf-8")
-        message_data = json.loads(message_data_str) if message_data_str else {}
+        message_data = orjson.loads(message_data_str) if message_data_str else {}
     except Exception as e:
         print(f"Erro ao decodificar mensagem: {e}")
         message_data = {}
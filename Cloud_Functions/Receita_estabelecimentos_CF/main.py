@@ -9,17 +9,32 @@ import os
 import re
 import io
 import zipfile
+import zlib
 import json
 import base64
+import html
+import random
+import shutil
+import time
 from pathlib import Path
 from urllib.parse import urljoin
-from typing import List, Dict, Tuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import List, Dict, Tuple, Set
 
 import requests
-from bs4 import BeautifulSoup
+import urllib3
 from google.cloud import storage
 import functions_framework
 
+# DEFLATE acelerado (ISA-L, 2-4x mais rápido) na extração dos ZIPs, se disponível
+try:
+    from isal import isal_zlib
+    zipfile.zlib = isal_zlib
+    zipfile.crc32 = isal_zlib.crc32
+    DECOMPRESSION_ERRORS = (zipfile.BadZipFile, zlib.error, isal_zlib.error)
+except ImportError:
+    DECOMPRESSION_ERRORS = (zipfile.BadZipFile, zlib.error)
+
 
 # =============================================================================
 # CONFIGURAÇÕES
@@ -36,43 +51,124 @@ ALLOWED_MONTHS = os.environ.get('ALLOWED_MONTHS', '').split(',')  # Vazio = todo
 # Configurações de download
 MAX_RETRIES = 3
 TIMEOUT = (30, 500)  # (connect timeout, read timeout)
+BACKOFF_BASE = 1.0  # Espera inicial entre tentativas (segundos)
+BACKOFF_MAX = 30.0  # Espera máxima entre tentativas (segundos)
 CHUNK_SIZE = 1048576
+UPLOAD_CHUNK_SIZE = 16 * 1024 * 1024  # Buffer do upload resumable para o GCS (múltiplo de 256 KiB)
+# Downloads simultâneos por pasta. Cada worker mantém um ZIP inteiro em memória
+# (até ~2 GiB nos maiores arquivos), então o pico é ~DOWNLOAD_WORKERS ZIPs:
+# só aumente se a memória da função comportar (ex.: 2 workers com --memory=8Gi)
+DOWNLOAD_WORKERS = int(os.environ.get('DOWNLOAD_WORKERS', '1'))
+# Conexões paralelas (HTTP Range) por arquivo grande; 1 = download em uma única conexão
+RANGE_SEGMENTS = int(os.environ.get('RANGE_SEGMENTS', '4'))
+MIN_RANGE_SIZE = 64 * 1048576  # Abaixo disso o arquivo é baixado em uma única conexão
+# Teto de conexões simultâneas com o servidor da Receita (acima disso ele limita/derruba conexões)
+MAX_CONNECTIONS = int(os.environ.get('MAX_CONNECTIONS', '8'))
+
+# Padrões da listagem HTML (índice de diretório do servidor)
+HREF_PATTERN = re.compile(r'href="([^"]+)"', re.IGNORECASE)
+FOLDER_PATTERN = re.compile(r'^\d{4}-\d{2}/$')  # Padrão: YYYY-MM/
+FILES_PATTERN = re.compile(r'Estabelecimentos?\d+\.zip', re.IGNORECASE)  # Padrão: EstabelecimentosN.zip
+DIGITS_PATTERN = re.compile(r'(\d+)')  # Trechos numéricos (ordenação natural dos arquivos)
+
+# Cache das listagens HTML por URL (vive enquanto a instância estiver quente)
+LISTING_CACHE: Dict[str, Dict] = {}
 
 # Inicializar cliente do Storage
 storage_client = storage.Client()
 bucket = storage_client.bucket(DESTINATION_BUCKET_NAME)
 
+# Sessão HTTP compartilhada (keep-alive: reaproveita conexões TCP/TLS entre requisições)
+# pool_block: com MAX_CONNECTIONS em uso, as threads aguardam uma conexão livre
+# em vez de abrir conexões extras (downloads e faixas paralelas somam conexões)
+SESSION = requests.Session()
+SESSION.mount('https://', requests.adapters.HTTPAdapter(pool_maxsize=MAX_CONNECTIONS, pool_block=True))
+
 
 # =============================================================================
 # FUNÇÕES AUXILIARES
 # =============================================================================
 
-def make_request_with_retry(url: str, max_retries: int = MAX_RETRIES) -> requests.Response:
+def backoff_delay(attempt: int, response: requests.Response = None) -> float:
+    """Espera entre tentativas: Retry-After da Receita ou backoff com jitter, sempre até BACKOFF_MAX"""
+    retry_after = response.headers.get('Retry-After', '') if response is not None else ''
+    if retry_after.isdigit():
+        return min(float(retry_after), BACKOFF_MAX)
+    return min(BACKOFF_MAX, BACKOFF_BASE * (2 ** attempt) * (1 + random.uniform(0, 0.5)))
+
+
+def is_retryable(error: requests.exceptions.RequestException) -> bool:
+    """Erros HTTP 4xx (exceto 408 e 429) não adiantam repetir"""
+    response = getattr(error, 'response', None)
+    if isinstance(error, requests.exceptions.HTTPError) and response is not None:
+        return not (400 <= response.status_code < 500) or response.status_code in (408, 429)
+    return True
+
+
+def make_request_with_retry(
+    url: str,
+    max_retries: int = MAX_RETRIES,
+    headers: Dict[str, str] = None
+) -> requests.Response:
     """Faz requisição HTTP com retry automático"""
     for attempt in range(max_retries):
         try:
             if attempt > 0:
                 print(f'   Tentativa {attempt + 1}/{max_retries}...')
             
-            response = requests.get(url, timeout=TIMEOUT, allow_redirects=True)
+            response = SESSION.get(url, headers=headers, timeout=TIMEOUT, allow_redirects=True)
             response.raise_for_status()
             return response
             
         except requests.exceptions.Timeout:
             if attempt < max_retries - 1:
                 print(f'   ⚠️  Timeout. Tentando novamente...')
+                time.sleep(backoff_delay(attempt))
             else:
                 raise
                 
-        except requests.exceptions.RequestException:
-            if attempt < max_retries - 1:
+        except requests.exceptions.RequestException as e:
+            if attempt < max_retries - 1 and is_retryable(e):
                 print(f'   ⚠️  Erro de conexão. Tentando novamente...')
+                time.sleep(backoff_delay(attempt, e.response))
             else:
                 raise
     
     raise Exception('Máximo de tentativas atingido')
 
 
+def extract_links(response: requests.Response) -> List[str]:
+    """Extrai os hrefs da listagem HTML do servidor"""
+    return [html.unescape(href) for href in HREF_PATTERN.findall(response.text)]
+
+
+def fetch_links(url: str) -> List[str]:
+    """
+    Busca a listagem HTML de uma URL e extrai os hrefs
+    Enquanto a instância estiver quente, reaproveita a última listagem da URL:
+    a requisição é condicional (ETag / Last-Modified) e um 304 dispensa o parse
+    """
+    cached = LISTING_CACHE.get(url)
+    headers = {}
+    if cached:
+        if cached['etag']:
+            headers['If-None-Match'] = cached['etag']
+        if cached['last_modified']:
+            headers['If-Modified-Since'] = cached['last_modified']
+    
+    response = make_request_with_retry(url, headers=headers)
+    if cached and response.status_code == 304:
+        return cached['links']
+    
+    links = extract_links(response)
+    LISTING_CACHE[url] = {
+        'etag': response.headers.get('ETag'),
+        'last_modified': response.headers.get('Last-Modified'),
+        'links': links
+    }
+    return links
+
+
 def get_available_folders(base_url: str) -> List[str]:
     """
     Lista todas as pastas ano-mês disponíveis no servidor
@@ -84,14 +180,11 @@ def get_available_folders(base_url: str) -> List[str]:
         print(f'   Meses filtrados: {", ".join(ALLOWED_MONTHS)}')
     
     try:
-        response = make_request_with_retry(base_url)
-        soup = BeautifulSoup(response.content, 'html.parser')
-        
+        links = fetch_links(base_url)
         folders = []
-        for link in soup.find_all('a'):
-            href = link.get('href', '')
+        for href in links:
             # Padrão: YYYY-MM/
-            if re.match(r'^\d{4}-\d{2}/$', href):
+            if FOLDER_PATTERN.match(href):
                 folder_date = href.rstrip('/')
                 
                 # Filtrar pelo período
@@ -118,21 +211,21 @@ def get_available_folders(base_url: str) -> List[str]:
         return []
 
 
+def natural_sort_key(name: str) -> Tuple:
+    """Chave de ordenação numérica: Arquivo2.zip vem antes de Arquivo10.zip"""
+    return tuple(int(part) if part.isdigit() else part.lower() for part in DIGITS_PATTERN.split(name))
+
+
 def get_estabelecimentos_files(folder_url: str) -> List[str]:
     """Lista todos os arquivos de Estabelecimentos de uma pasta"""
     try:
-        response = make_request_with_retry(folder_url)
-        soup = BeautifulSoup(response.content, 'html.parser')
-        
+        links = fetch_links(folder_url)
         files = []
-        pattern = re.compile(r'Estabelecimentos?\d+\.zip', re.IGNORECASE)
-        
-        for link in soup.find_all('a'):
-            href = link.get('href', '')
-            if pattern.match(href):
+        for href in links:
+            if FILES_PATTERN.match(href):
                 files.append(href)
         
-        files.sort()
+        files.sort(key=natural_sort_key)
         return files
         
     except Exception as e:
@@ -152,6 +245,19 @@ def check_extraction_marker(folder_name: str, zip_name: str) -> bool:
     return blob_exists(marker_path)
 
 
+def list_extraction_markers(folder_name: str) -> Set[str]:
+    """
+    Lista de uma só vez os ZIPs já extraídos de uma pasta
+    Retorna os nomes (sem extensão) que possuem marcador de extração
+    """
+    prefix = f'{BASE_PATH}/{folder_name}/.'
+    return {
+        Path(blob.name).name[1:-len('.extracted')]
+        for blob in bucket.list_blobs(prefix=prefix)
+        if blob.name.endswith('.extracted')
+    }
+
+
 def create_extraction_marker(folder_name: str, zip_name: str):
     """Cria marcador de extração no bucket"""
     marker_path = f'{BASE_PATH}/{folder_name}/.{Path(zip_name).stem}.extracted'
@@ -160,64 +266,118 @@ def create_extraction_marker(folder_name: str, zip_name: str):
     print(f'   ✓ Marcador criado: {marker_path}')
 
 
-def download_and_extract_to_gcs(url: str, folder_name: str, file_name: str) -> Tuple[bool, bool]:
+def download_ranges(url: str, size: int) -> io.BytesIO:
+    """
+    Baixa o arquivo em RANGE_SEGMENTS faixas paralelas (HTTP Range)
+    Cada faixa é escrita direto na sua posição do buffer pré-alocado; uma faixa
+    que falha é retomada de onde parou, sem reiniciar o arquivo inteiro
+    """
+    zip_content = io.BytesIO()
+    zip_content.seek(size - 1)
+    zip_content.write(b'\0')
+    view = zip_content.getbuffer()
+    segment_size = -(-size // RANGE_SEGMENTS)
+    
+    def fetch_range(start: int):
+        end = min(start + segment_size, size)
+        position = start
+        for attempt in range(MAX_RETRIES):
+            try:
+                headers = {'Range': f'bytes={position}-{end - 1}'}
+                with SESSION.get(url, headers=headers, stream=True, timeout=TIMEOUT) as response:
+                    response.raise_for_status()
+                    if response.status_code != 206:
+                        raise IOError(f'Servidor ignorou o cabeçalho Range (HTTP {response.status_code})')
+                    while position < end:
+                        read = response.raw.readinto(view[position:end])
+                        if not read:
+                            break
+                        position += read
+                if position == end:
+                    return
+                raise requests.exceptions.ConnectionError(f'Faixa incompleta ({position}/{end} bytes)')
+            except (requests.exceptions.RequestException, urllib3.exceptions.HTTPError) as e:
+                if attempt == MAX_RETRIES - 1 or not is_retryable(e):
+                    raise
+                time.sleep(backoff_delay(attempt, getattr(e, 'response', None)))
+    
+    try:
+        with ThreadPoolExecutor(max_workers=RANGE_SEGMENTS) as executor:
+            list(executor.map(fetch_range, range(0, size, segment_size)))
+    finally:
+        view.release()
+    
+    return zip_content
+
+
+def download_zip(url: str) -> io.BytesIO:
+    """
+    Baixa o ZIP para um buffer em memória
+    Arquivos grandes, em servidores que aceitam HTTP Range, são baixados em faixas
+    paralelas (uma única conexão TCP raramente satura o link)
+    """
+    head = SESSION.head(url, timeout=TIMEOUT, allow_redirects=True)
+    size = int(head.headers.get('Content-Length', 0)) if head.ok else 0
+    if RANGE_SEGMENTS > 1 and size >= MIN_RANGE_SIZE and head.headers.get('Accept-Ranges') == 'bytes':
+        return download_ranges(url, size)
+    
+    # O with devolve a conexão ao pool mesmo se a leitura falhar no meio
+    with SESSION.get(url, stream=True, timeout=TIMEOUT) as response:
+        response.raise_for_status()
+        
+        # Ler conteúdo do ZIP em memória (cópia em nível C, blocos de CHUNK_SIZE)
+        zip_content = io.BytesIO()
+        response.raw.decode_content = True
+        shutil.copyfileobj(response.raw, zip_content, length=CHUNK_SIZE)
+    return zip_content
+
+
+def download_and_extract_to_gcs(url: str, folder_name: str, file_name: str,
+                                check_marker: bool = True) -> Tuple[bool, bool]:
     """
     Baixa ZIP, extrai conteúdo para GCS e deleta ZIP (em memória)
+    check_marker=False quando o chamador já filtrou os extraídos (listagem dos marcadores)
     Retorna: (download_success, extraction_success)
     """
     try:
         # Verificar se já foi extraído
-        if check_extraction_marker(folder_name, file_name):
+        if check_marker and check_extraction_marker(folder_name, file_name):
             print(f'   ⏭️  {file_name}: Já extraído, pulando...')
             return (True, True)
         
         print(f'   ⬇️  {file_name}: Baixando...')
         
         # Download do arquivo ZIP em memória
-        response = requests.get(url, stream=True, timeout=TIMEOUT)
-        response.raise_for_status()
-        
-        # Ler conteúdo do ZIP em memória
-        zip_content = io.BytesIO()
-        total_size = int(response.headers.get('content-length', 0))
-        downloaded = 0
-        
-        for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
-            if chunk:
-                zip_content.write(chunk)
-                downloaded += len(chunk)
-                if total_size > 0:
-                    percent = (downloaded / total_size) * 100
-                    if downloaded % (CHUNK_SIZE * 100) == 0:  # Log a cada ~800KB
-                        print(f'   {file_name}: {percent:.1f}%')
+        zip_content = download_zip(url)
+        downloaded = zip_content.getbuffer().nbytes
         
         print(f'   ✅ {file_name}: Download concluído ({downloaded / 1024 / 1024:.1f} MB)')
         
+        # Checagem barata (só o registro EOCD no fim do arquivo): descarta páginas
+        # de erro ou downloads truncados antes de tentar extrair
+        if not zipfile.is_zipfile(zip_content):
+            raise zipfile.BadZipFile('Conteúdo baixado não é um ZIP válido')
+        
         # Extrair e fazer upload dos arquivos
         print(f'   📦 {file_name}: Extraindo e enviando para GCS...')
         zip_content.seek(0)
         
         with zipfile.ZipFile(zip_content, 'r') as zip_ref:
-            # Testar integridade
-            if zip_ref.testzip() is not None:
-                print(f'   ❌ {file_name}: ZIP corrompido')
-                return (True, False)
-            
-            # Extrair cada arquivo
+            # Extrair cada arquivo (o CRC é verificado durante a leitura de cada membro)
             members = zip_ref.namelist()
             files_uploaded = 0
             
             for member in members:
                 if not member.endswith('/'):  # Ignorar diretórios
-                    # Ler arquivo do ZIP
-                    file_data = zip_ref.read(member)
-                    
                     # Caminho no bucket: BASE_PATH/folder_name/arquivo.csv
                     blob_path = f'{BASE_PATH}/{folder_name}/{member}'
                     blob = bucket.blob(blob_path)
                     
-                    # Upload para GCS
-                    blob.upload_from_string(file_data, content_type='text/csv')
+                    # Upload para GCS em streaming (sem descompactar o arquivo inteiro em memória)
+                    # Se a cópia falhar, o upload resumable é cancelado (nenhum CSV parcial é publicado)
+                    with zip_ref.open(member) as src, \
+                            blob.open('wb', chunk_size=UPLOAD_CHUNK_SIZE, content_type='text/csv') as dst:
+                        shutil.copyfileobj(src, dst, length=CHUNK_SIZE)
                     files_uploaded += 1
                     
                     if files_uploaded % 5 == 0:
@@ -228,7 +388,8 @@ def download_and_extract_to_gcs(url: str, folder_name: str, file_name: str) -> T
             # Criar marcador de extração
             create_extraction_marker(folder_name, file_name)
         
-        # ZIP é automaticamente deletado (estava em memória)
+        # Libera o buffer do ZIP imediatamente (sem esperar o coletor de lixo)
+        zip_content.close()
         print(f'   🗑️  {file_name}: ZIP removido da memória')
         
         return (True, True)
@@ -237,7 +398,7 @@ def download_and_extract_to_gcs(url: str, folder_name: str, file_name: str) -> T
         print(f'   ❌ {file_name}: Timeout no download')
         return (False, False)
         
-    except zipfile.BadZipFile:
+    except DECOMPRESSION_ERRORS:
         print(f'   ❌ {file_name}: Arquivo ZIP inválido')
         return (True, False)
         
@@ -319,21 +480,32 @@ def process_folder(folder: str) -> Dict[str, int]:
         'failed': 0
     }
     
-    # Processar cada arquivo
-    for idx, file_name in enumerate(files, 1):
-        print(f'\n[{idx}/{len(files)}] {file_name}')
-        
+    # Descartar os já extraídos com uma única listagem de marcadores da pasta
+    extracted = list_extraction_markers(folder_name)
+    pending = [file_name for file_name in files if Path(file_name).stem not in extracted]
+    stats['skipped'] = len(files) - len(pending)
+    
+    if stats['skipped']:
+        print(f'⏭️  {stats["skipped"]} arquivos já extraídos, pulando...')
+    
+    def process_file(idx: int, file_name: str) -> Tuple[bool, bool]:
+        print(f'\n[{idx}/{len(pending)}] {file_name}')
         file_url = urljoin(folder_url, file_name)
-        download_ok, extract_ok = download_and_extract_to_gcs(file_url, folder_name, file_name)
-        
+        return download_and_extract_to_gcs(file_url, folder_name, file_name, check_marker=False)
+    
+    # Pool de DOWNLOAD_WORKERS arquivos (padrão 1: um ZIP por vez, por memória;
+    # a concorrência padrão está nas faixas HTTP Range de cada arquivo grande)
+    with ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS) as executor:
+        futures = {
+            executor.submit(process_file, idx, file_name): file_name
+            for idx, file_name in enumerate(pending, 1)
+        }
+        results = [(futures[future], future.result()) for future in as_completed(futures)]
+    
+    for file_name, (download_ok, extract_ok) in results:
         if download_ok and extract_ok:
-            if check_extraction_marker(folder_name, file_name):
-                stats['skipped'] += 1
-            else:
-                stats['downloaded'] += 1
-                stats['extracted'] += 1
-        elif download_ok and not extract_ok:
-            stats['failed'] += 1
+            stats['downloaded'] += 1
+            stats['extracted'] += 1
         else:
             stats['failed'] += 1
     
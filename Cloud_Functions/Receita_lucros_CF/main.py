@@ -9,17 +9,34 @@ import os
 import re
 import io
 import zipfile
+import zlib
 import json
 import base64
+import html
+import random
+import shutil
+import time
+import queue
+import threading
 from pathlib import Path
 from urllib.parse import urljoin
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Dict, Tuple
 
 import requests
-from bs4 import BeautifulSoup
+from google.api_core.exceptions import NotFound
 from google.cloud import storage
 import functions_framework
 
+# DEFLATE acelerado (ISA-L, 2-4x mais rápido) na extração dos ZIPs, se disponível
+try:
+    from isal import isal_zlib
+    zipfile.zlib = isal_zlib
+    zipfile.crc32 = isal_zlib.crc32
+    DECOMPRESSION_ERRORS = (zipfile.BadZipFile, zlib.error, isal_zlib.error)
+except ImportError:
+    DECOMPRESSION_ERRORS = (zipfile.BadZipFile, zlib.error)
+
 
 # =============================================================================
 # CONFIGURAÇÕES
@@ -39,43 +56,109 @@ REGIME_FILES = [
 # Configurações de download
 MAX_RETRIES = 3
 TIMEOUT = (30, 500)  # (connect timeout, read timeout)
+BACKOFF_BASE = 1.0  # Espera inicial entre tentativas (segundos)
+BACKOFF_MAX = 30.0  # Espera máxima entre tentativas (segundos)
 CHUNK_SIZE = 1048576
+UPLOAD_CHUNK_SIZE = 16 * 1024 * 1024  # Buffer do upload resumable para o GCS (múltiplo de 256 KiB)
+
+# Padrões da listagem HTML (índice de diretório do servidor)
+HREF_PATTERN = re.compile(r'href="([^"]+)"', re.IGNORECASE)
+
+# Cache das listagens HTML por URL (vive enquanto a instância estiver quente)
+LISTING_CACHE: Dict[str, Dict] = {}
 
 # Inicializar cliente do Storage
 storage_client = storage.Client()
 bucket = storage_client.bucket(DESTINATION_BUCKET_NAME)
 
+# Sessão HTTP compartilhada (keep-alive: reaproveita conexões TCP/TLS entre requisições)
+SESSION = requests.Session()
+
 
 # =============================================================================
 # FUNÇÕES AUXILIARES
 # =============================================================================
 
-def make_request_with_retry(url: str, max_retries: int = MAX_RETRIES) -> requests.Response:
+def backoff_delay(attempt: int, response: requests.Response = None) -> float:
+    """Espera entre tentativas: Retry-After da Receita ou backoff com jitter, sempre até BACKOFF_MAX"""
+    retry_after = response.headers.get('Retry-After', '') if response is not None else ''
+    if retry_after.isdigit():
+        return min(float(retry_after), BACKOFF_MAX)
+    return min(BACKOFF_MAX, BACKOFF_BASE * (2 ** attempt) * (1 + random.uniform(0, 0.5)))
+
+
+def is_retryable(error: requests.exceptions.RequestException) -> bool:
+    """Erros HTTP 4xx (exceto 408 e 429) não adiantam repetir"""
+    response = getattr(error, 'response', None)
+    if isinstance(error, requests.exceptions.HTTPError) and response is not None:
+        return not (400 <= response.status_code < 500) or response.status_code in (408, 429)
+    return True
+
+
+def make_request_with_retry(
+    url: str,
+    max_retries: int = MAX_RETRIES,
+    headers: Dict[str, str] = None
+) -> requests.Response:
     """Faz requisição HTTP com retry automático"""
     for attempt in range(max_retries):
         try:
             if attempt > 0:
                 print(f'   Tentativa {attempt + 1}/{max_retries}...')
             
-            response = requests.get(url, timeout=TIMEOUT, allow_redirects=True)
+            response = SESSION.get(url, headers=headers, timeout=TIMEOUT, allow_redirects=True)
             response.raise_for_status()
             return response
             
         except requests.exceptions.Timeout:
             if attempt < max_retries - 1:
                 print(f'   ⚠️  Timeout. Tentando novamente...')
+                time.sleep(backoff_delay(attempt))
             else:
                 raise
                 
-        except requests.exceptions.RequestException:
-            if attempt < max_retries - 1:
+        except requests.exceptions.RequestException as e:
+            if attempt < max_retries - 1 and is_retryable(e):
                 print(f'   ⚠️  Erro de conexão. Tentando novamente...')
+                time.sleep(backoff_delay(attempt, e.response))
             else:
                 raise
     
     raise Exception('Máximo de tentativas atingido')
 
 
+def extract_links(response: requests.Response) -> List[str]:
+    """Extrai os hrefs da listagem HTML do servidor"""
+    return [html.unescape(href) for href in HREF_PATTERN.findall(response.text)]
+
+
+def fetch_links(url: str) -> List[str]:
+    """
+    Busca a listagem HTML de uma URL e extrai os hrefs
+    Enquanto a instância estiver quente, reaproveita a última listagem da URL:
+    a requisição é condicional (ETag / Last-Modified) e um 304 dispensa o parse
+    """
+    cached = LISTING_CACHE.get(url)
+    headers = {}
+    if cached:
+        if cached['etag']:
+            headers['If-None-Match'] = cached['etag']
+        if cached['last_modified']:
+            headers['If-Modified-Since'] = cached['last_modified']
+    
+    response = make_request_with_retry(url, headers=headers)
+    if cached and response.status_code == 304:
+        return cached['links']
+    
+    links = extract_links(response)
+    LISTING_CACHE[url] = {
+        'etag': response.headers.get('ETag'),
+        'last_modified': response.headers.get('Last-Modified'),
+        'links': links
+    }
+    return links
+
+
 def get_available_regime_files(base_url: str) -> List[str]:
     """
     Lista todos os arquivos de regime tributário disponíveis no servidor
@@ -84,12 +167,9 @@ def get_available_regime_files(base_url: str) -> List[str]:
     print(f'🔍 Buscando arquivos de regime tributário em: {base_url}')
     
     try:
-        response = make_request_with_retry(base_url)
-        soup = BeautifulSoup(response.content, 'html.parser')
-        
+        links = fetch_links(base_url)
         files = []
-        for link in soup.find_all('a'):
-            href = link.get('href', '')
+        for href in links:
             # Buscar arquivos .zip relevantes
             if href.endswith('.zip') and any(regime_name.lower() in href.lower() 
                                             for regime_name in ['lucro', 'imunes', 'isentas']):
@@ -115,101 +195,147 @@ def blob_exists(blob_path: str) -> bool:
     return blob.exists()
 
 
-def check_extraction_marker(zip_name: str) -> bool:
-    """Verifica se existe marcador de extração para um ZIP"""
+def get_remote_version(headers) -> str:
+    """
+    Identifica a versão do arquivo remoto a partir dos headers HTTP
+    Usa o ETag ou, na falta dele, Content-Length + Last-Modified
+    """
+    if headers.get('ETag'):
+        return headers['ETag']
+    if headers.get('Content-Length') or headers.get('Last-Modified'):
+        return f"{headers.get('Content-Length', '')}|{headers.get('Last-Modified', '')}"
+    return ''
+
+
+def fetch_remote_version(url: str) -> str:
+    """Consulta a versão do arquivo remoto via HEAD (vazio se não for possível)"""
+    try:
+        response = SESSION.head(url, timeout=TIMEOUT, allow_redirects=True)
+        response.raise_for_status()
+        return get_remote_version(response.headers)
+    except requests.exceptions.RequestException:
+        return ''
+
+
+def check_extraction_marker(zip_name: str, url: str = None) -> bool:
+    """
+    Verifica se existe marcador de extração para um ZIP
+    Se a URL for informada, compara a versão gravada no marcador com a do
+    servidor (HEAD): os arquivos de regime tributário são republicados com o
+    mesmo nome, então um marcador de versão antiga não conta como extraído
+    """
     marker_path = f'{BASE_PATH}/.{Path(zip_name).stem}.extracted'
-    return blob_exists(marker_path)
+    try:
+        stored_version = bucket.blob(marker_path).download_as_text()
+    except NotFound:
+        return False
+    
+    # Marcadores antigos não guardam versão
+    if url is None or stored_version == 'extracted':
+        return True
+    
+    remote_version = fetch_remote_version(url)
+    return not remote_version or remote_version == stored_version
 
 
-def create_extraction_marker(zip_name: str):
-    """Cria marcador de extração no bucket"""
+def create_extraction_marker(zip_name: str, version: str = ''):
+    """Cria marcador de extração no bucket (conteúdo: versão do arquivo remoto)"""
     marker_path = f'{BASE_PATH}/.{Path(zip_name).stem}.extracted'
     blob = bucket.blob(marker_path)
-    blob.upload_from_string('extracted', content_type='text/plain')
+    blob.upload_from_string(version or 'extracted', content_type='text/plain')
     print(f'   ✓ Marcador criado: {marker_path}')
 
 
-def download_and_extract_to_gcs(url: str, file_name: str) -> Tuple[bool, bool]:
+def download_zip(url: str, file_name: str) -> Tuple[io.BytesIO, str]:
     """
-    Baixa ZIP, extrai conteúdo para GCS e deleta ZIP (em memória)
-    Retorna: (download_success, extraction_success)
+    Baixa o ZIP para a memória
+    Retorna: (buffer com o conteúdo do ZIP, versão do arquivo remoto)
     """
-    try:
-        # Verificar se já foi extraído
-        if check_extraction_marker(file_name):
-            print(f'   ⏭️  {file_name}: Já extraído, pulando...')
-            return (True, True)
-        
-        print(f'   ⬇️  {file_name}: Baixando...')
-        
-        # Download do arquivo ZIP em memória
-        response = requests.get(url, stream=True, timeout=TIMEOUT)
+    print(f'   ⬇️  {file_name}: Baixando...')
+    
+    with SESSION.get(url, stream=True, timeout=TIMEOUT) as response:
         response.raise_for_status()
         
-        # Ler conteúdo do ZIP em memória
+        # Ler conteúdo do ZIP em memória (cópia em nível C, blocos de CHUNK_SIZE)
         zip_content = io.BytesIO()
-        total_size = int(response.headers.get('content-length', 0))
-        downloaded = 0
+        response.raw.decode_content = True
+        shutil.copyfileobj(response.raw, zip_content, length=CHUNK_SIZE)
+        downloaded = zip_content.tell()
+        version = get_remote_version(response.headers)
+    
+    print(f'   ✅ {file_name}: Download concluído ({downloaded / 1024 / 1024:.1f} MB)')
+    
+    # Checagem barata (só o registro EOCD no fim do arquivo): descarta páginas
+    # de erro ou downloads truncados antes de tentar extrair
+    if not zipfile.is_zipfile(zip_content):
+        raise zipfile.BadZipFile('Conteúdo baixado não é um ZIP válido')
+    
+    zip_content.seek(0)
+    return zip_content, version
+
+
+def extract_zip_to_gcs(zip_content: io.BytesIO, file_name: str, version: str = '') -> bool:
+    """
+    Extrai o ZIP em memória para o GCS e cria o marcador de extração
+    Retorna: extraction_success
+    """
+    print(f'   📦 {file_name}: Extraindo e enviando para GCS...')
+    
+    with zipfile.ZipFile(zip_content, 'r') as zip_ref:
+        # Extrair cada arquivo (o CRC é verificado durante a leitura de cada membro)
+        members = zip_ref.namelist()
+        files_uploaded = 0
         
-        for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
-            if chunk:
-                zip_content.write(chunk)
-                downloaded += len(chunk)
-                if total_size > 0:
-                    percent = (downloaded / total_size) * 100
-                    if downloaded % (CHUNK_SIZE * 100) == 0:  # Log a cada ~100MB
-                        print(f'   {file_name}: {percent:.1f}%')
+        # Criar subdiretório baseado no nome do arquivo (sem extensão)
+        regime_type = Path(file_name).stem
         
-        print(f'   ✅ {file_name}: Download concluído ({downloaded / 1024 / 1024:.1f} MB)')
+        for member in members:
+            if not member.endswith('/'):  # Ignorar diretórios
+                # Caminho no bucket: BASE_PATH/tipo_regime/arquivo.csv
+                blob_path = f'{BASE_PATH}/{regime_type}/{member}'
+                blob = bucket.blob(blob_path)
+                
+                # Upload para GCS em streaming (sem descompactar o arquivo inteiro em memória)
+                # Se a cópia falhar, o upload resumable é cancelado (nenhum CSV parcial é publicado)
+                with zip_ref.open(member) as src, \
+                        blob.open('wb', chunk_size=UPLOAD_CHUNK_SIZE, content_type='text/csv') as dst:
+                    shutil.copyfileobj(src, dst, length=CHUNK_SIZE)
+                files_uploaded += 1
+                
+                if files_uploaded % 5 == 0:
+                    print(f'   ... {files_uploaded}/{len(members)} arquivos enviados')
         
-        # Extrair e fazer upload dos arquivos
-        print(f'   📦 {file_name}: Extraindo e enviando para GCS...')
-        zip_content.seek(0)
+        print(f'   ✅ {file_name}: {files_uploaded} arquivos extraídos para GCS')
         
-        with zipfile.ZipFile(zip_content, 'r') as zip_ref:
-            # Testar integridade
-            if zip_ref.testzip() is not None:
-                print(f'   ❌ {file_name}: ZIP corrompido')
-                return (True, False)
-            
-            # Extrair cada arquivo
-            members = zip_ref.namelist()
-            files_uploaded = 0
-            
-            # Criar subdiretório baseado no nome do arquivo (sem extensão)
-            regime_type = Path(file_name).stem
-            
-            for member in members:
-                if not member.endswith('/'):  # Ignorar diretórios
-                    # Ler arquivo do ZIP
-                    file_data = zip_ref.read(member)
-                    
-                    # Caminho no bucket: BASE_PATH/tipo_regime/arquivo.csv
-                    blob_path = f'{BASE_PATH}/{regime_type}/{member}'
-                    blob = bucket.blob(blob_path)
-                    
-                    # Upload para GCS
-                    blob.upload_from_string(file_data, content_type='text/csv')
-                    files_uploaded += 1
-                    
-                    if files_uploaded % 5 == 0:
-                        print(f'   ... {files_uploaded}/{len(members)} arquivos enviados')
-            
-            print(f'   ✅ {file_name}: {files_uploaded} arquivos extraídos para GCS')
-            
-            # Criar marcador de extração
-            create_extraction_marker(file_name)
-        
-        # ZIP é automaticamente deletado (estava em memória)
-        print(f'   🗑️  {file_name}: ZIP removido da memória')
+        # Criar marcador de extração
+        create_extraction_marker(file_name, version)
+    
+    # Libera o buffer do ZIP imediatamente (sem esperar o coletor de lixo)
+    zip_content.close()
+    print(f'   🗑️  {file_name}: ZIP removido da memória')
+    
+    return True
+
+
+def download_and_extract_to_gcs(url: str, file_name: str) -> Tuple[bool, bool]:
+    """
+    Baixa ZIP, extrai conteúdo para GCS e deleta ZIP (em memória)
+    Retorna: (download_success, extraction_success)
+    """
+    try:
+        # Verificar se já foi extraído
+        if check_extraction_marker(file_name, url):
+            print(f'   ⏭️  {file_name}: Já extraído, pulando...')
+            return (True, True)
         
-        return (True, True)
+        zip_content, version = download_zip(url, file_name)
+        return (True, extract_zip_to_gcs(zip_content, file_name, version))
         
     except requests.exceptions.Timeout:
         print(f'   ❌ {file_name}: Timeout no download')
         return (False, False)
         
-    except zipfile.BadZipFile:
+    except DECOMPRESSION_ERRORS:
         print(f'   ❌ {file_name}: Arquivo ZIP inválido')
         return (True, False)
         
@@ -272,22 +398,70 @@ def process_all_files() -> Dict[str, int]:
         'failed': 0
     }
     
-    # Processar cada arquivo
-    for idx, file_name in enumerate(files, 1):
-        print(f'\n[{idx}/{len(files)}] {file_name}')
-        
-        file_url = urljoin(BASE_URL, file_name)
-        download_ok, extract_ok = download_and_extract_to_gcs(file_url, file_name)
-        
-        if download_ok and extract_ok:
-            # Verificar se foi realmente processado ou apenas pulado
-            if check_extraction_marker(file_name):
+    # Pipeline: a extração de um ZIP (CPU + upload) roda numa thread dedicada
+    # enquanto o próximo ZIP é baixado. O semáforo só libera um novo download
+    # quando uma extração termina, então há no máximo 2 ZIPs em memória
+    # (um sendo extraído e outro sendo baixado ou aguardando na fila).
+    extraction_queue = queue.Queue(maxsize=1)
+    zip_slots = threading.Semaphore(2)
+    extraction_results = {}
+    
+    def extract_worker():
+        for file_name, zip_content, version in iter(extraction_queue.get, None):
+            try:
+                extraction_results[file_name] = extract_zip_to_gcs(zip_content, file_name, version)
+            except DECOMPRESSION_ERRORS:
+                print(f'   ❌ {file_name}: Arquivo ZIP inválido')
+                extraction_results[file_name] = False
+            except Exception as e:
+                print(f'   ❌ {file_name}: Erro - {str(e)[:100]}')
+                extraction_results[file_name] = False
+            finally:
+                # Não manter o ZIP vivo na variável do loop enquanto aguarda o próximo
+                zip_content.close()
+                zip_slots.release()
+    
+    # Verificar os marcadores (leitura no GCS + HEAD no servidor) de todos os
+    # arquivos de uma vez, em vez de uma ida e volta por arquivo dentro do loop
+    file_urls = [urljoin(BASE_URL, file_name) for file_name in files]
+    with ThreadPoolExecutor(max_workers=max(1, len(files))) as executor:
+        already_extracted = list(executor.map(check_extraction_marker, files, file_urls))
+    
+    extractor = threading.Thread(target=extract_worker, daemon=True)
+    extractor.start()
+    
+    try:
+        for idx, (file_name, file_url, extracted) in enumerate(zip(files, file_urls, already_extracted), 1):
+            print(f'\n[{idx}/{len(files)}] {file_name}')
+            
+            if extracted:
+                print(f'   ⏭️  {file_name}: Já extraído, pulando...')
                 stats['skipped'] += 1
-            else:
-                stats['downloaded'] += 1
-                stats['extracted'] += 1
-        elif download_ok and not extract_ok:
-            stats['failed'] += 1
+                continue
+            
+            zip_slots.acquire()
+            try:
+                zip_content, version = download_zip(file_url, file_name)
+            except requests.exceptions.Timeout:
+                print(f'   ❌ {file_name}: Timeout no download')
+                stats['failed'] += 1
+                zip_slots.release()
+                continue
+            except Exception as e:
+                print(f'   ❌ {file_name}: Erro - {str(e)[:100]}')
+                stats['failed'] += 1
+                zip_slots.release()
+                continue
+            
+            stats['downloaded'] += 1
+            extraction_queue.put((file_name, zip_content, version))
+    finally:
+        extraction_queue.put(None)
+        extractor.join()
+    
+    for extract_ok in extraction_results.values():
+        if extract_ok:
+            stats['extracted'] += 1
         else:
             stats['failed'] += 1
     
@@ -6,6 +6,9 @@ Baseado em dados temporais (cnpj + ano_mes)
 import pandas as pd
 import numpy as np
 from datetime import datetime
+import hashlib
+import json
+import os
 import warnings
 warnings.filterwarnings('ignore')
 
@@ -27,6 +30,11 @@ try:
 except ImportError:
     XGBOOST_AVAILABLE = False
     print("XGBoost não disponível. Usando RandomForest como padrão.")
+try:
+    import pyarrow  # noqa: F401
+    PYARROW_AVAILABLE = True
+except ImportError:
+    PYARROW_AVAILABLE = False
 import joblib
 
 # Visualizações
@@ -37,26 +45,48 @@ import seaborn as sns
 plt.style.use('seaborn-v0_8-darkgrid')
 sns.set_palette("husl")
 
+# Parâmetros das features (também fazem parte da chave do cache de features)
+LAG_PERIODS = [1, 2, 3, 6, 12]
+ROLLING_WINDOWS = [3, 6, 12]
+PGFN_LAG_PERIODS = [1, 2, 3]
+PGFN_ROLLING_WINDOWS = [3, 6]
+# Incrementar sempre que a lógica das features mudar (invalida o cache em Parquet)
+FEATURES_VERSION = 1
+
+# Diretório do cache de features em Parquet (vazio = cache desativado)
+FEATURES_CACHE_DIR = os.environ.get('FEATURES_CACHE_DIR') or None
+
+# Caracteres removidos da UF quando ela vem como lista (ex.: "['SP']")
+UF_TRANSLATION = str.maketrans('', '', "[]'")
+
+# Dispositivo de treino do XGBoost ('cpu' ou 'cuda')
+XGBOOST_DEVICE = os.environ.get('XGBOOST_DEVICE', 'cpu')
+
 
 class SituacaoCadastralPredictor:
     """
     Classe para prever situação cadastral baseado em dados temporais
     """
     
-    def __init__(self, model_type='xgboost'):
+    def __init__(self, model_type='xgboost', cache_dir=None):
         """
         Inicializa o predictor
         
         Args:
             model_type: 'xgboost' ou 'random_forest'
+            cache_dir: diretório para cache das features em Parquet (None desativa)
         """
         self.model_type = model_type
+        self.cache_dir = cache_dir
         self.model = None
         self.label_encoder = LabelEncoder()
         self.scaler = StandardScaler()
         self.feature_columns = None
         self.categorical_encoders = {}  # Armazena encoders por coluna categórica
         self.is_trained = False
+        # Última geração de features: (hash do conteúdo da entrada, df_clean, colunas)
+        # train e predict costumam receber o mesmo DataFrame
+        self._features_memo = None
         
     def load_data(self, file_path):
         """
@@ -66,11 +96,16 @@ class SituacaoCadastralPredictor:
             file_path: caminho para o arquivo CSV
         """
         print("Carregando dados...")
-        df = pd.read_csv(file_path)
+        if PYARROW_AVAILABLE:
+            # Parser do pyarrow lê o CSV em várias threads
+            df = pd.read_csv(file_path, engine='pyarrow')
+        else:
+            df = pd.read_csv(file_path)
         
-        # Remove coluna de índice se existir
-        if 'Unnamed: 0' in df.columns:
-            df = df.drop('Unnamed: 0', axis=1)
+        # Remove coluna de índice se existir (o pyarrow a nomeia como '')
+        index_cols = [col for col in ('Unnamed: 0', '') if col in df.columns]
+        if index_cols:
+            df = df.drop(index_cols, axis=1)
         
         # Converte ano_mes para datetime
         df['data_ref'] = pd.to_datetime(df['data_ref'])
@@ -79,6 +114,10 @@ class SituacaoCadastralPredictor:
         # Ordena por cnpj e data
         df = df.sort_values(['cnpj', 'ano_mes']).reset_index(drop=True)
         
+        # CNPJ como categórico: os groupby usam os códigos inteiros em vez de
+        # fazer hash do CNPJ a cada agrupamento
+        df['cnpj'] = df['cnpj'].astype('category')
+        
         print(f"Dados carregados: {len(df)} registros")
         print(f"CNPJs únicos: {df['cnpj'].nunique()}")
         print(f"Período: {df['ano_mes'].min()} a {df['ano_mes'].max()}")
@@ -91,35 +130,69 @@ class SituacaoCadastralPredictor:
         """
         print("Criando features temporais...")
         
-        # Extrai componentes de data
-        df['ano'] = df['ano_mes'].dt.year
-        df['mes'] = df['ano_mes'].dt.month
-        df['trimestre'] = df['ano_mes'].dt.quarter
-        df['semestre'] = (df['mes'] <= 6).astype(int) + 1
-        df['mes_sin'] = np.sin(2 * np.pi * df['mes'] / 12)
-        df['mes_cos'] = np.cos(2 * np.pi * df['mes'] / 12)
-        
-        # Número de meses desde o início do dataset
-        min_date = df['ano_mes'].min()
-        df['meses_desde_inicio'] = (
-            (df['ano_mes'].dt.year - min_date.year) * 12 + 
-            (df['ano_mes'].dt.month - min_date.month)
-        )
+        # Extrai ano/mês uma única vez como arrays inteiros; as demais features
+        # temporais são aritmética sobre eles (assign não altera o DataFrame do chamador).
+        # Datas ausentes (NaT) são preenchidas só para o cálculo e viram NaN no
+        # fim, como antes: essas linhas são descartadas no dropna de prepare_features
+        invalidas = df['ano_mes'].isna().to_numpy()
+        datas = df['ano_mes'].fillna(pd.Timestamp('1970-01-01')).dt
+        anos = datas.year.to_numpy(dtype=np.int16)
+        meses = datas.month.to_numpy(dtype=np.int8)
+        angulo = (2 * np.pi / 12) * meses
+        
+        # Número de meses desde o início do dataset (ordem das datas = ordem de ano*12+mês)
+        meses_absolutos = anos.astype(np.int32) * 12 + meses
+        inicio = meses_absolutos.min(where=~invalidas, initial=np.iinfo(np.int32).max)
+        
+        temporal_features = {
+            'ano': anos,
+            'mes': meses,
+            'trimestre': ((meses - 1) // 3 + 1).astype(np.int8),
+            'semestre': (meses <= 6).astype(np.int8) + 1,
+            'mes_sin': np.sin(angulo),
+            'mes_cos': np.cos(angulo),
+            'meses_desde_inicio': (meses_absolutos - inicio).astype(np.int16)
+        }
+        if invalidas.any():
+            temporal_features = {
+                name: np.where(invalidas, np.nan, values)
+                for name, values in temporal_features.items()
+            }
         
+        return df.assign(**temporal_features)
+    
+    def _sort_and_group(self, df):
+        """
+        Ordena por (cnpj, ano_mes) e agrupa por CNPJ
+        
+        O GroupBy fica ligado ao DataFrame ordenado devolvido; as features de
+        lag, rolling e agregadas são adicionadas nesse mesmo frame (in-place),
+        então o agrupamento nunca aponta para uma cópia antiga
+        """
+        df = df.sort_values(['cnpj', 'ano_mes']).reset_index(drop=True)
+        return df, df.groupby('cnpj', sort=False, observed=True)
+    
+    def _add_columns(self, df, features):
+        """
+        Adiciona as colunas ao próprio DataFrame, numa única operação
+        (assign copiaria o frame inteiro no pandas 2.x)
+        """
+        df[list(features)] = pd.DataFrame(features, index=df.index)
         return df
     
-    def create_lag_features(self, df, lag_periods=[1, 2, 3, 6, 12]):
+    def create_lag_features(self, df, lag_periods=LAG_PERIODS, grouped=None):
         """
         Cria features de lag para cada empresa
+        
+        Se grouped for informado, df já deve estar ordenado por (cnpj, ano_mes)
+        e grouped deve ter sido criado sobre ele; as colunas são adicionadas no
+        próprio df
         """
         print("Criando features de lag...")
         
         # Agrupa por CNPJ e ordena por data
-        df = df.sort_values(['cnpj', 'ano_mes']).reset_index(drop=True)
-        
-        # Features de lag para situação cadastral
-        for lag in lag_periods:
-            df[f'situacao_cadastral_lag_{lag}'] = df.groupby('cnpj')['situacao_cadastral'].shift(lag)
+        if grouped is None:
+            df, grouped = self._sort_and_group(df)
         
         # Features de lag para valores PGFN
         pgfn_cols = [
@@ -128,98 +201,200 @@ class SituacaoCadastralPredictor:
             'pgfn_prev_valor_acumulado_t_minus_1',
             'pgfn_fgts_ajuizados_t_minus_1'
         ]
-        
+        pgfn_cols = [col for col in pgfn_cols if col in df.columns]
+        pgfn_lags = PGFN_LAG_PERIODS
+        
+        # Com o DataFrame ordenado, cada empresa ocupa linhas contíguas: o lag é
+        # um deslocamento do array inteiro, anulando as linhas cuja posição na
+        # empresa é menor que o lag (equivale ao groupby.shift, sem o agrupamento)
+        position = grouped.cumcount().to_numpy()
+        shifted = {}
+        for lag in sorted(set(lag_periods) | set(pgfn_lags)):
+            cols = (['situacao_cadastral'] if lag in lag_periods else []) + (pgfn_cols if lag in pgfn_lags else [])
+            if cols:
+                values = df[cols].to_numpy(dtype='float64')
+                lagged = np.full_like(values, np.nan)
+                if lag < len(values):
+                    lagged[lag:] = values[:len(values) - lag]
+                lagged[position < lag] = np.nan
+                shifted[lag] = pd.DataFrame(lagged, columns=cols, index=df.index)
+        
+        # Features de lag (mesma ordem de colunas de antes)
+        lag_features = {
+            f'situacao_cadastral_lag_{lag}': shifted[lag]['situacao_cadastral']
+            for lag in lag_periods
+        }
         for col in pgfn_cols:
-            if col in df.columns:
-                for lag in [1, 2, 3]:
-                    df[f'{col}_lag_{lag}'] = df.groupby('cnpj')[col].shift(lag)
+            for lag in pgfn_lags:
+                lag_features[f'{col}_lag_{lag}'] = shifted[lag][col]
         
-        return df
+        return self._add_columns(df, lag_features)
     
-    def create_rolling_features(self, df, windows=[3, 6, 12]):
+    def create_rolling_features(self, df, windows=ROLLING_WINDOWS, grouped=None):
         """
         Cria features de rolling statistics por empresa
+        (as colunas são adicionadas no próprio df)
         """
         print("Criando features de rolling statistics...")
         
-        # Rolling mean e std da situação cadastral
+        if grouped is None:
+            grouped = df.groupby('cnpj', sort=False, observed=True)
+        rolling_features = {}
+        
+        # Rolling mean e std da situação cadastral (uma janela móvel calcula as duas)
         for window in windows:
-            df[f'situacao_cadastral_rolling_mean_{window}'] = (
-                df.groupby('cnpj')['situacao_cadastral']
-                .rolling(window=window, min_periods=1)
-                .mean()
-                .reset_index(0, drop=True)
-            )
-            
-            df[f'situacao_cadastral_rolling_std_{window}'] = (
-                df.groupby('cnpj')['situacao_cadastral']
+            stats = (
+                grouped['situacao_cadastral']
                 .rolling(window=window, min_periods=1)
-                .std()
-                .fillna(0)
+                .agg(['mean', 'std'])
                 .reset_index(0, drop=True)
             )
+            rolling_features[f'situacao_cadastral_rolling_mean_{window}'] = stats['mean']
+            rolling_features[f'situacao_cadastral_rolling_std_{window}'] = stats['std'].fillna(0)
         
-        # Rolling sum para valores PGFN
+        # Rolling sum para valores PGFN (todas as colunas na mesma janela móvel)
         pgfn_cols = [
             'pgfn_fgts_valor_acumulado_t_minus_1',
             'pgfn_naoprev_valor_acumulado_t_minus_1',
             'pgfn_prev_valor_acumulado_t_minus_1'
         ]
+        pgfn_cols = [col for col in pgfn_cols if col in df.columns]
+        pgfn_windows = PGFN_ROLLING_WINDOWS
+        
+        if pgfn_cols:
+            sums = {
+                window: (
+                    grouped[pgfn_cols]
+                    .rolling(window=window, min_periods=1)
+                    .sum()
+                    .reset_index(0, drop=True)
+                )
+                for window in pgfn_windows
+            }
+            for col in pgfn_cols:
+                for window in pgfn_windows:
+                    rolling_features[f'{col}_rolling_sum_{window}'] = sums[window][col]
         
-        for col in pgfn_cols:
-            if col in df.columns:
-                for window in [3, 6]:
-                    df[f'{col}_rolling_sum_{window}'] = (
-                        df.groupby('cnpj')[col]
-                        .rolling(window=window, min_periods=1)
-                        .sum()
-                        .reset_index(0, drop=True)
-                    )
-        
-        return df
+        return self._add_columns(df, rolling_features)
     
-    def create_aggregated_features(self, df):
+    def create_aggregated_features(self, df, grouped=None):
         """
         Cria features agregadas por empresa
+        (as colunas são adicionadas no próprio df)
         """
         print("Criando features agregadas...")
         
-        # Features históricas por empresa
-        empresa_stats = df.groupby('cnpj').agg({
-            'situacao_cadastral': ['mean', 'std', 'min', 'max', 'count'],
-            'pgfn_fgts_valor_acumulado_t_minus_1': ['mean', 'max', 'sum'],
-            'pgfn_naoprev_valor_acumulado_t_minus_1': ['mean', 'max', 'sum'],
-            'pgfn_prev_valor_acumulado_t_minus_1': ['mean', 'max', 'sum'],
-            'tempo_atividade_anos': 'first'
-        }).reset_index()
-        
-        # Flatten column names
-        empresa_stats.columns = ['cnpj'] + [
-            '_'.join(col).strip() if col[1] else col[0] 
-            for col in empresa_stats.columns[1:]
+        # Features históricas por empresa (transform devolve o agregado já
+        # alinhado às linhas, sem precisar de merge)
+        if grouped is None:
+            grouped = df.groupby('cnpj', sort=False, observed=True)
+        pgfn_cols = [
+            'pgfn_fgts_valor_acumulado_t_minus_1',
+            'pgfn_naoprev_valor_acumulado_t_minus_1',
+            'pgfn_prev_valor_acumulado_t_minus_1'
+        ]
+        aggregations = [
+            ('situacao_cadastral', ['mean', 'std', 'min', 'max', 'count']),
+            *[(col, ['mean', 'max', 'sum']) for col in pgfn_cols],
+            ('tempo_atividade_anos', ['first'])
         ]
         
-        # Merge de volta
-        df = df.merge(empresa_stats, on='cnpj', suffixes=('', '_empresa'))
+        empresa_features = {}
+        for col, funcs in aggregations:
+            for func in funcs:
+                empresa_features[f'{col}_{func}'] = grouped[col].transform(func)
         
         # Posição temporal relativa (primeiro, último, meio)
-        df['posicao_temporal'] = df.groupby('cnpj').cumcount()
-        df['total_registros_empresa'] = df.groupby('cnpj')['cnpj'].transform('count')
-        df['posicao_relativa'] = df['posicao_temporal'] / df['total_registros_empresa']
+        empresa_features['posicao_temporal'] = grouped.cumcount()
+        empresa_features['total_registros_empresa'] = grouped['cnpj'].transform('size')
+        empresa_features['posicao_relativa'] = (
+            empresa_features['posicao_temporal'] / empresa_features['total_registros_empresa']
+        )
+        df = self._add_columns(df, empresa_features)
         
         return df
     
+    def _feature_cache_key(self, df):
+        """
+        Chave do cache de features: conteúdo do DataFrame de entrada + parâmetros
+        e versão da lógica das features
+        """
+        hasher = hashlib.sha256()
+        hasher.update(pd.util.hash_pandas_object(df, index=True).to_numpy().tobytes())
+        hasher.update(json.dumps([
+            FEATURES_VERSION,
+            {str(col): str(dtype) for col, dtype in df.dtypes.items()},
+            LAG_PERIODS, ROLLING_WINDOWS, PGFN_LAG_PERIODS, PGFN_ROLLING_WINDOWS
+        ]).encode())
+        return hasher.hexdigest()[:16]
+    
     def prepare_features(self, df):
         """
         Prepara todas as features para o modelo
+        
+        Gera as features (build_features) e, se o modelo ainda não foi
+        treinado, registra as colunas selecionadas
+        """
+        df_clean, feature_cols = self.build_features(df)
+        
+        # Só atualiza self.feature_columns se o modelo não foi treinado ainda
+        # (durante o treino, será atualizado depois da codificação)
+        if not self.is_trained:
+            self.feature_columns = list(feature_cols)
+        
+        return df_clean
+    
+    def build_features(self, df):
+        """
+        Gera as features sem alterar o estado do modelo
+        
+        O resultado da última chamada fica em memória, identificado pelo hash do
+        conteúdo da entrada, e é reaproveitado quando a mesma entrada é
+        preparada de novo (o DataFrame devolvido é compartilhado: não deve ser
+        alterado in-place). Se cache_dir estiver definido, também é salvo em
+        Parquet e reaproveitado entre execuções.
+        
+        Returns:
+            (df_clean, feature_cols)
         """
         print("\n=== Preparando Features ===")
         
+        cache_key = self._feature_cache_key(df)
+        if self._features_memo is not None and self._features_memo[0] == cache_key:
+            print("Features reaproveitadas da preparação anterior")
+            return self._features_memo[1], self._features_memo[2]
+        
+        cache_path = None
+        if self.cache_dir and PYARROW_AVAILABLE:
+            cache_path = os.path.join(self.cache_dir, f'features_{cache_key}.parquet')
+            meta_path = os.path.join(self.cache_dir, f'features_{cache_key}.json')
+            
+            if os.path.exists(cache_path) and os.path.exists(meta_path):
+                print(f"Features carregadas do cache: {cache_path}")
+                with open(meta_path) as f:
+                    meta = json.load(f)
+                feature_cols = meta['feature_columns']
+                # O Parquet não preserva todos os dtypes (ex.: cnpj categórico,
+                # resolução do datetime): restaura os da execução original; as
+                # categóricas usam as categorias do DataFrame recebido
+                dtypes = meta['dtypes']
+                dtypes.update({
+                    col: df[col].dtype for col in df.columns
+                    if col in dtypes and isinstance(df[col].dtype, pd.CategoricalDtype)
+                })
+                df_clean = pd.read_parquet(cache_path, engine='pyarrow').astype(dtypes)
+                
+                self._features_memo = (cache_key, df_clean, feature_cols)
+                return df_clean, feature_cols
+        
         # Cria todas as features
+        # (uma única ordenação e um único GroupBy por CNPJ: lag, rolling e
+        # agregadas adicionam suas colunas no mesmo frame ordenado, sem cópias)
         df = self.create_temporal_features(df)
-        df = self.create_lag_features(df)
-        df = self.create_rolling_features(df)
-        df = self.create_aggregated_features(df)
+        df, grouped = self._sort_and_group(df)
+        df = self.create_lag_features(df, grouped=grouped)
+        df = self.create_rolling_features(df, grouped=grouped)
+        df = self.create_aggregated_features(df, grouped=grouped)
         
         # Seleciona features para o modelo
         feature_cols = [
@@ -272,15 +447,39 @@ class SituacaoCadastralPredictor:
         else:
             df_clean = df.dropna(subset=feature_cols).copy()
         
+        # Reduz precisão numérica das features (float64 -> float32, inteiros no
+        # menor tipo): metade da memória no fit, e o XGBoost já trabalha em float32.
+        # Só as colunas de features: o target e as demais colunas mantêm o dtype
+        # (fazem parte da saída do predict), e as categóricas viram string na
+        # codificação. Os valores PGFN perdem precisão absoluta (float32 tem ~7
+        # dígitos: erro da ordem de dezenas de reais perto de 1e9), irrelevante
+        # para os splits das árvores, que já são feitos em float32
+        categorical_cols = ['cnae_fiscal_principal', 'uf']
+        numeric_features = df_clean[[
+            col for col in feature_cols
+            if col not in categorical_cols and col != 'situacao_cadastral'
+        ]]
+        float_cols = numeric_features.select_dtypes('float64').columns
+        int_cols = numeric_features.select_dtypes('integer').columns
+        df_clean[float_cols] = df_clean[float_cols].astype('float32')
+        df_clean[int_cols] = df_clean[int_cols].apply(pd.to_numeric, downcast='integer')
+        
         print(f"\nFeatures selecionadas: {len(feature_cols)}")
         print(f"Registros após limpeza: {len(df_clean)}")
         
-        # Só atualiza self.feature_columns se o modelo não foi treinado ainda
-        # (durante o treino, será atualizado depois da codificação)
-        if not self.is_trained:
-            self.feature_columns = feature_cols
+        if cache_path:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            df_clean.to_parquet(cache_path, engine='pyarrow', compression='zstd')
+            with open(meta_path, 'w') as f:
+                json.dump({
+                    'feature_columns': feature_cols,
+                    'dtypes': {str(col): str(dtype) for col, dtype in df_clean.dtypes.items()}
+                }, f)
+            print(f"Features salvas no cache: {cache_path}")
         
-        return df_clean
+        self._features_memo = (cache_key, df_clean, feature_cols)
+        
+        return df_clean, feature_cols
     
     def encode_categorical_features(self, df, fit=True):
         """
@@ -288,8 +487,7 @@ class SituacaoCadastralPredictor:
         """
         # Converte UF (pode estar como lista)
         if 'uf' in df.columns:
-            df['uf'] = df['uf'].astype(str).str.replace(r"\[|\]|'", '', regex=True)
-            df['uf'] = df['uf'].str.strip()
+            df['uf'] = df['uf'].astype(str).str.translate(UF_TRANSLATION).str.strip()
         
         # CNAE como string
         if 'cnae_fiscal_principal' in df.columns:
@@ -308,9 +506,9 @@ class SituacaoCadastralPredictor:
         """
         print("\n=== Treinando Modelo ===")
         
-        # Prepara features
+        # Prepara features (o DataFrame preparado fica em memória para o predict,
+        # por isso a limpeza das categóricas é feita só nas seleções X_train/X_test)
         df = self.prepare_features(df)
-        df = self.encode_categorical_features(df, fit=True)
         
         # Separação temporal
         if validation_split_date:
@@ -330,6 +528,9 @@ class SituacaoCadastralPredictor:
             y_train = df.iloc[:split_idx]['situacao_cadastral']
             y_test = df.iloc[split_idx:]['situacao_cadastral']
         
+        X_train = self.encode_categorical_features(X_train, fit=True)
+        X_test = self.encode_categorical_features(X_test, fit=True)
+        
         print(f"Treino: {len(X_train)} registros")
         print(f"Teste: {len(X_test)} registros")
         
@@ -349,9 +550,8 @@ class SituacaoCadastralPredictor:
             
             X_train[col + '_encoded'] = le.transform(X_train[col].astype(str))
             # Para valores não vistos, usa 0 (ou pode usar o valor mais frequente)
-            X_test[col + '_encoded'] = X_test[col].astype(str).apply(
-                lambda x: le.transform([x])[0] if x in le.classes_ else 0
-            )
+            mapping = {cls: i for i, cls in enumerate(le.classes_)}
+            X_test[col + '_encoded'] = X_test[col].astype(str).map(mapping).fillna(0).astype(int)
             
             # Remove coluna original
             X_train = X_train.drop(col, axis=1)
@@ -376,7 +576,12 @@ class SituacaoCadastralPredictor:
                 colsample_bytree=0.8,
                 random_state=42,
                 eval_metric='mlogloss',
-                use_label_encoder=False
+                use_label_encoder=False,
+                # Histogramas em vez de split exato; XGBOOST_DEVICE=cuda usa GPU
+                tree_method='hist',
+                max_bin=256,
+                n_jobs=-1,
+                device=XGBOOST_DEVICE
             )
         else:
             if self.model_type == 'xgboost' and not XGBOOST_AVAILABLE:
@@ -443,8 +648,13 @@ class SituacaoCadastralPredictor:
         if len(df_filtered) == 0:
             raise ValueError(f"Não há dados disponíveis até {ano_mes}")
         
-        # Pega o último registro de cada empresa
-        df_last = df_filtered.sort_values(['cnpj', 'ano_mes']).groupby('cnpj').last().reset_index()
+        # Pega o último registro de cada empresa: prepare_features já devolve os
+        # dados ordenados por (cnpj, ano_mes), então basta marcar a linha em que
+        # o CNPJ muda (após o dropna, as colunas usadas não têm NaN, logo a
+        # última linha é igual ao groupby().last())
+        cnpjs = df_filtered['cnpj'].to_numpy()
+        last_mask = np.r_[cnpjs[:-1] != cnpjs[1:], True]
+        df_last = df_filtered[last_mask].reset_index(drop=True)
         
         # Prepara features
         # Primeiro, precisa codificar as categóricas antes de selecionar as colunas
@@ -457,10 +667,10 @@ class SituacaoCadastralPredictor:
         for col in categorical_cols:
             if col in df_work.columns and col in self.categorical_encoders:
                 le = self.categorical_encoders[col]
-                # Para valores não vistos, usa 0
-                df_work[col + '_encoded'] = df_work[col].astype(str).apply(
-                    lambda x: le.transform([x])[0] if x in le.classes_ else 0
-                )
+                # Para valores não vistos, usa 0 (lookup em dicionário, sem
+                # chamar le.transform linha a linha)
+                mapping = {cls: i for i, cls in enumerate(le.classes_)}
+                df_work[col + '_encoded'] = df_work[col].astype(str).map(mapping).fillna(0).astype(int)
         
         # Remove colunas categóricas originais se existirem (IMPORTANTE: antes de selecionar)
         for col in categorical_cols:
@@ -511,22 +721,27 @@ class SituacaoCadastralPredictor:
         if unexpected:
             X = X.drop(columns=unexpected)
         
-        # Faz previsão
-        predictions = self.model.predict(X)
+        # Faz previsão: a classe predita é o argmax das probabilidades (o mesmo
+        # que model.predict faz), então basta uma chamada ao modelo
         probabilities = self.model.predict_proba(X)
+        classes = self.model.classes_
+        pred_idx = probabilities.argmax(axis=1)
         
-        # Adiciona ao DataFrame
-        df_last['situacao_cadastral_predita'] = predictions
-        df_last['probabilidade_max'] = probabilities.max(axis=1)
+        # Monta as colunas de previsão e as probabilidades por classe de uma vez
+        prob_df = pd.DataFrame(
+            probabilities,
+            columns=[f'prob_classe_{c}' for c in classes],
+            index=df_last.index
+        )
+        prob_df.insert(0, 'situacao_cadastral_predita', classes[pred_idx])
+        prob_df.insert(1, 'probabilidade_max', probabilities[np.arange(len(pred_idx)), pred_idx])
         
-        # Adiciona probabilidades por classe
-        classes = self.model.classes_
-        for i, class_val in enumerate(classes):
-            df_last[f'prob_classe_{class_val}'] = probabilities[:, i]
+        # cnpj é categórico só internamente (groupby); a saída volta ao dtype original
+        result = df_last[['cnpj', 'ano_mes', 'situacao_cadastral']]
+        if isinstance(result['cnpj'].dtype, pd.CategoricalDtype):
+            result = result.assign(cnpj=result['cnpj'].astype(result['cnpj'].cat.categories.dtype))
         
-        return df_last[['cnpj', 'ano_mes', 'situacao_cadastral', 
-                        'situacao_cadastral_predita', 'probabilidade_max'] + 
-                       [f'prob_classe_{c}' for c in classes]]
+        return pd.concat([result, prob_df], axis=1)
     
     def save_model(self, filepath):
         """Salva o modelo treinado"""
@@ -538,7 +753,7 @@ class SituacaoCadastralPredictor:
             'feature_columns': self.feature_columns,
             'model_type': self.model_type,
             'categorical_encoders': self.categorical_encoders
-        }, filepath)
+        }, filepath, compress=3)  # zlib: joblib.load descomprime automaticamente
         print(f"Modelo salvo em {filepath}")
     
     def load_model(self, filepath):
@@ -555,8 +770,8 @@ class SituacaoCadastralPredictor:
 def main():
     """Função principal para treinar e avaliar o modelo"""
     
-    # Inicializa predictor
-    predictor = SituacaoCadastralPredictor(model_type='xgboost')
+    # Inicializa predictor (cache de features em Parquet só se FEATURES_CACHE_DIR estiver definido)
+    predictor = SituacaoCadastralPredictor(model_type='xgboost', cache_dir=FEATURES_CACHE_DIR)
     
     # Carrega dados
     df = predictor.load_data('dataset_silver.csv')